@@ -0,0 +1,189 @@
+"""Export ZIP: l'archivio dipende da dettagli interni di zipfile (patch dell'intestazione locale,
+ricostruzione delle voci alla ripresa), quindi va verificato a ogni aggiornamento di Python.
+
+Esecuzione: python -m unittest discover -s tests
+"""
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ver
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+
+class ExportArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db_path = os.path.join(self.tmp.name, 'macchine_tracker.db')
+        self.zip_path = os.path.join(self.tmp.name, 'archivio.zip')
+        self.expected = {}
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE interventi (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, data_ora TEXT NOT NULL, macchina TEXT NOT NULL,
+                operatore TEXT NOT NULL, categoria TEXT NOT NULL, problema TEXT NOT NULL, soluzione TEXT NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE allegati (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, intervento_id INTEGER NOT NULL, nome_file TEXT NOT NULL,
+                tipo_file TEXT NOT NULL, contenuto BLOB NOT NULL, codec TEXT NOT NULL DEFAULT 'raw'
+            )
+        ''')
+        for i in range(23):
+            intervento_id = conn.execute('''
+                INSERT INTO interventi (uuid, data_ora, macchina, operatore, categoria, problema, soluzione)
+                VALUES (?, ?, ?, 'op', 'Altro', ?, 'sostituito')
+            ''', (f'u{i}', f'2025-03-{i + 1:02d} 08:30:00', f'Pressa {i % 3}', f'perdita olio {i} città')).lastrowid
+            attachments = [(f'nota {i}.txt', 'txt', f'riga di log {i}\n'.encode() * (50 + i * 20))]
+            if i % 2:
+                attachments.append(('foto.png', 'image', PNG_HEADER + os.urandom(3000)))
+            if i == 7:
+                # Oltre la soglia dello spool: il worker passa dal buffer in memoria al file temporaneo
+                attachments.append(('grande.txt', 'txt', b'0123456789abcdef' * (ver.ARCHIVE_SPOOL_MEMORY // 8)))
+                attachments.append(('vuoto.txt', 'txt', b''))
+            for nome_file, tipo_file, data in attachments:
+                codec, contenuto = ver.compress_payload(data)
+                allegato_id = conn.execute('''
+                    INSERT INTO allegati (intervento_id, nome_file, tipo_file, contenuto, codec) VALUES (?, ?, ?, ?, ?)
+                ''', (intervento_id, nome_file, tipo_file, contenuto, codec)).lastrowid
+                self.expected[ver.archive_entry_name(intervento_id, allegato_id, nome_file)] = data
+        conn.commit()
+        conn.close()
+
+    def assertArchiveComplete(self):
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            names = zf.namelist()
+            self.assertEqual(len(names), len(set(names)))
+            for name, data in self.expected.items():
+                self.assertEqual(zf.read(name), data, name)
+                info = zf.getinfo(name)
+                if data.startswith(PNG_HEADER):
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                elif data:
+                    self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                    self.assertLess(info.compress_size, info.file_size)
+
+            manifest = [json.loads(line) for name in sorted(names) if name.startswith('manifest/')
+                        for line in zf.read(name).decode('utf-8').splitlines()]
+            self.assertEqual([row['id'] for row in manifest], list(range(1, 24)))
+            self.assertEqual(sum(len(row['allegati']) for row in manifest), len(self.expected))
+
+            rows = list(csv.reader(io.StringIO(zf.read('interventi.csv').decode('utf-8-sig'))))
+            self.assertEqual(rows[0], list(ver.ARCHIVE_CSV_FIELDS) + ['allegati'])
+            self.assertEqual(len(rows), 24)
+            self.assertEqual(rows[1][6], 'perdita olio 0 città')
+        self.assertFalse(os.path.exists(self.zip_path + ver.ARCHIVE_RESUME_SUFFIX))
+        self.assertFalse(os.path.exists(self.zip_path + ver.ARCHIVE_ENTRIES_SUFFIX))
+
+    def test_round_trip(self):
+        state = ver.export_archive(self.db_path, self.zip_path)
+        self.assertTrue(state['completato'])
+        self.assertEqual((state['interventi'], state['allegati']), (23, len(self.expected)))
+        self.assertArchiveComplete()
+
+    def test_filtered_export(self):
+        state = ver.export_archive(self.db_path, self.zip_path, 'macchina = ?', ['Pressa 1'])
+        self.assertEqual(state['interventi'], 8)
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(len(zf.read('interventi.csv').decode('utf-8-sig').splitlines()), 9)
+
+    @mock.patch.object(ver, 'ARCHIVE_BATCH_SIZE', 5)
+    def test_cancel_and_resume(self):
+        cancel = threading.Event()
+
+        def progress(done, total):
+            if done >= 10:
+                cancel.set()
+
+        state = ver.export_archive(self.db_path, self.zip_path, progress=progress, cancel=cancel)
+        self.assertFalse(state['completato'])
+        self.assertEqual(state['interventi'], 10)
+        with zipfile.ZipFile(self.zip_path) as zf:
+            # L'archivio interrotto resta leggibile fino all'ultimo blocco
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(len([name for name in zf.namelist() if name.startswith('manifest/')]), 2)
+
+        # Dati scritti dopo il checkpoint da un processo terminato bruscamente
+        with open(self.zip_path, 'ab') as f:
+            f.write(os.urandom(4096))
+
+        state = ver.read_archive_resume(self.zip_path, self.db_path)
+        self.assertEqual(state['last_id'], 10)
+        state = ver.export_archive(self.db_path, self.zip_path, state=state, progress=progress)
+        self.assertTrue(state['completato'])
+        self.assertEqual(state['interventi'], 23)
+        self.assertArchiveComplete()
+
+    @mock.patch.object(ver, 'ARCHIVE_BATCH_SIZE', 5)
+    def test_resume_after_crash_between_checkpoints(self):
+        calls = []
+        real_checkpoint = ver._archive_checkpoint
+
+        def crash_on_third(zf, zip_path, state):
+            calls.append(state['last_id'])
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            real_checkpoint(zf, zip_path, state)
+
+        with mock.patch.object(ver, '_archive_checkpoint', crash_on_third):
+            with self.assertRaises(KeyboardInterrupt):
+                ver.export_archive(self.db_path, self.zip_path)
+
+        state = ver.read_archive_resume(self.zip_path, self.db_path)
+        self.assertEqual(state['last_id'], 10)
+        ver.export_archive(self.db_path, self.zip_path, state=state)
+        self.assertArchiveComplete()
+
+    @mock.patch.object(ver, 'ARCHIVE_BATCH_SIZE', 5)
+    def test_discard_interrupted_export(self):
+        cancel = threading.Event()
+
+        def progress(done, total):
+            if done >= 5:
+                cancel.set()
+
+        ver.export_archive(self.db_path, self.zip_path, progress=progress, cancel=cancel)
+        self.assertIsNotNone(ver.read_archive_resume(self.zip_path, self.db_path))
+
+        ver.discard_archive(self.zip_path)
+        for suffix in ('', ver.ARCHIVE_RESUME_SUFFIX, ver.ARCHIVE_ENTRIES_SUFFIX):
+            self.assertFalse(os.path.exists(self.zip_path + suffix))
+
+    def test_original_error_is_not_hidden(self):
+        def failing_spool(db_path, allegato_id):
+            raise RuntimeError('lettura allegato fallita')
+
+        real_close = zipfile.ZipFile.close
+
+        def failing_close(zf):
+            # Lo zip viene comunque chiuso davvero: nessuna directory centrale lasciata al garbage collector
+            if zf.fp is None:
+                return
+            real_close(zf)
+            raise OSError('disco pieno')
+
+        # Anche se la chiusura dello zip fallisce a sua volta (es. disco pieno) resta visibile l'errore originale
+        with mock.patch.object(ver, 'spool_attachment', failing_spool), \
+                mock.patch.object(zipfile.ZipFile, 'close', failing_close):
+            with self.assertRaisesRegex(RuntimeError, 'lettura allegato fallita'):
+                ver.export_archive(self.db_path, self.zip_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,1967 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+import time
+import glob
 import base64
-from PIL import Image, ImageGrab, ImageTk
+from PIL import Image, ImageGrab, ImageOps, ImageTk
 import io
+import codecs
 from difflib import SequenceMatcher
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill
+import numpy as np
+import csv
+import zlib
+import hashlib
+import json
+import uuid
+import socket
+import zipfile
+import re
+import itertools
+from collections import OrderedDict, deque
+import shutil
+import tempfile
+import sys
+import threading
+import traceback
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+
+CODEC_RAW = 'raw'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+# Firme dei formati gia' compressi (PNG, JPEG, GIF, WEBP, ZIP/DOCX): non vale la pena ricomprimerli
+COMPRESSED_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'RIFF', b'PK\x03\x04')
+
+
+def is_already_compressed(data):
+    return data[:8].startswith(COMPRESSED_SIGNATURES)
+
+
+def compress_payload(data):
+    """Restituisce (codec, contenuto) da salvare nella colonna allegati.contenuto"""
+    if len(data) < 256 or is_already_compressed(data):
+        return CODEC_RAW, data
+
+    if zstandard is not None:
+        codec, compressed = CODEC_ZSTD, zstandard.ZstdCompressor(level=10).compress(data)
+    else:
+        codec, compressed = CODEC_ZLIB, zlib.compress(data, 6)
+
+    if len(compressed) >= len(data):
+        return CODEC_RAW, data
+    return codec, compressed
+
+
+def iter_decompressed(codec, chunks):
+    """Decomprime in streaming una sequenza di blocchi letti dal database"""
+    if codec == CODEC_RAW:
+        yield from chunks
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Allegato compresso con zstd: installa il pacchetto 'zstandard'")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+    else:
+        raise ValueError(f"Codec allegato sconosciuto: {codec}")
+
+
+# Solo i testi possono guadagnare dalla compressione: immagini e DOCX sono gia' compressi
+COMPRESSIBLE_TYPES = ('txt',)
+RECOMPRESS_BATCH_SIZE = 20
+
+
+def recompress_attachments_job(db_path):
+    """Job nel pool di worker: comprime i testi salvati in chiaro, a lotti, con una connessione propria.
+
+    L'ultimo id esaminato resta in impostazioni: gli allegati nuovi sono gia' compressi
+    all'inserimento, quindi un nuovo avvio riparte da li' invece di rileggere tutto.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    stats = {'rows': 0, 'before': 0, 'after': 0}
+    try:
+        row = conn.execute("SELECT valore FROM impostazioni WHERE chiave = 'ricompressione_ultimo_id'").fetchone()
+        last_id = int(row[0]) if row else 0
+        placeholders = ', '.join('?' * len(COMPRESSIBLE_TYPES))
+        while True:
+            rows = conn.execute(f'''
+                SELECT id, contenuto FROM allegati
+                WHERE codec = ? AND tipo_file IN ({placeholders}) AND id > ?
+                ORDER BY id LIMIT ?
+            ''', (CODEC_RAW,) + COMPRESSIBLE_TYPES + (last_id, RECOMPRESS_BATCH_SIZE)).fetchall()
+            if rows:
+                last_id = rows[-1][0]
+            else:
+                last_id = max(last_id, conn.execute('SELECT COALESCE(MAX(id), 0) FROM allegati').fetchone()[0])
+
+            with conn:
+                for allegato_id, contenuto in rows:
+                    codec, compressed = compress_payload(contenuto)
+                    stats['rows'] += 1
+                    stats['before'] += len(contenuto)
+                    stats['after'] += len(compressed)
+                    if codec != CODEC_RAW:
+                        conn.execute('UPDATE allegati SET contenuto = ?, codec = ? WHERE id = ?',
+                                     (compressed, codec, allegato_id))
+                conn.execute("INSERT OR REPLACE INTO impostazioni (chiave, valore) VALUES ('ricompressione_ultimo_id', ?)",
+                             (str(last_id),))
+            if len(rows) < RECOMPRESS_BATCH_SIZE:
+                return stats
+    finally:
+        conn.close()
+
+
+IMAGE_FORMATS = ('AUTO', 'JPEG', 'PNG', 'WEBP')
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif', 'BMP': '.bmp'}
+ANIMATED_IMAGE_FORMATS = ('GIF', 'PNG', 'WEBP')
+IMAGE_POLICY_DEFAULT = {'max_side': 1920, 'format': 'AUTO', 'quality': 85}
+
+EXIF_ORIENTATION = 0x0112
+
+IDLE_MAINTENANCE_INTERVAL_MS = 5000
+IDLE_THRESHOLD_S = 30
+INCREMENTAL_VACUUM_PAGES = 64
+
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_CHECK_INTERVAL_MS = 10 * 60 * 1000
+BACKUP_DEFAULTS = {'folder': 'backup', 'interval_hours': 24, 'copies': 7}
+# Le copie automatiche hanno un prefisso proprio: la rotazione non tocca mai i backup manuali
+BACKUP_AUTO_SUFFIX = '_auto'
+# Dopo un backup automatico fallito si riprova con attesa crescente, al massimo ogni intervallo
+BACKUP_RETRY_BASE_S = 15 * 60
+
+
+def table_counts(conn):
+    return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in ('interventi', 'allegati')}
+
+
+def verify_backup(path):
+    """Controlla l'integrita' del backup e prova a ripristinarlo in un file temporaneo"""
+    restore_path = path + '.verify'
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"Controllo di integrità fallito: {result}")
+        expected = table_counts(conn)
+
+        restored = sqlite3.connect(restore_path)
+        try:
+            conn.backup(restored, pages=BACKUP_PAGES_PER_STEP)
+            if table_counts(restored) != expected:
+                raise sqlite3.DatabaseError("Verifica del ripristino fallita: conteggi diversi")
+        finally:
+            restored.close()
+    finally:
+        conn.close()
+        if os.path.exists(restore_path):
+            os.remove(restore_path)
+    return expected
+
+
+def backup_database(source_path, dest_path, progress=None):
+    """Backup a caldo con l'API di SQLite: copia a blocchi di pagine, poi verifica la copia"""
+    tmp_path = dest_path + '.tmp'
+
+    def on_step(status, remaining, total):
+        if progress:
+            progress(total - remaining, total)
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=on_step, sleep=0.01)
+    finally:
+        target.close()
+        source.close()
+
+    try:
+        counts = verify_backup(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, dest_path)
+    return counts
+
+
+SYNC_BUNDLE_VERSION = 1
+SYNC_INTERVENTO_FIELDS = ('data_ora', 'macchina', 'operatore', 'categoria', 'problema', 'soluzione')
+SYNC_ALLEGATO_FIELDS = ('nome_file', 'tipo_file', 'hash_contenuto')
+
+# Origine della modifica: vuota per le modifiche locali, ID della sede durante un'importazione
+SYNC_ORIGIN_SQL = "COALESCE((SELECT valore FROM impostazioni WHERE chiave = 'sync_origine'), '')"
+NEW_UUID_SQL = "lower(hex(randomblob(16)))"
+
+
+def prune_backups(folder, prefix, keep):
+    backups = sorted(glob.glob(os.path.join(folder, f'{prefix}_*.db')))
+    for old_backup in backups[:-keep] if keep > 0 else []:
+        os.remove(old_backup)
+
+
+def format_size(num_bytes):
+    if num_bytes >= 1024 * 1024:
+        return f"{num_bytes / (1024 * 1024):.1f} MB"
+    return f"{num_bytes / 1024:.0f} KB"
+
+
+def normalize_image(data, max_side, target_format, quality):
+    """Applica la policy di acquisizione: raddrizza secondo l'EXIF, riduce al lato massimo e ricodifica.
+
+    Restituisce (dati, formato). Se l'immagine e' gia' conforme o la ricodifica non fa risparmiare
+    spazio vengono restituiti i dati originali.
+    """
+    image = Image.open(io.BytesIO(data))
+    source_format = image.format
+    # Solo i formati di animazione restano intatti: le MPO, pur multi-frame, seguono la normalizzazione
+    if source_format in ANIMATED_IMAGE_FORMATS and getattr(image, 'is_animated', False):
+        return data, source_format
+
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+    too_large = max(image.size) > max_side
+
+    if target_format == 'AUTO':
+        # Screenshot e grafica restano lossless, le foto diventano JPEG
+        if source_format in ('PNG', 'GIF') or 'A' in image.getbands():
+            target_format = 'PNG'
+        else:
+            target_format = 'JPEG'
+
+    if source_format == target_format and not too_large and orientation == 1:
+        return data, source_format
+
+    image = ImageOps.exif_transpose(image)
+    if too_large:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    if target_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+
+    output = io.BytesIO()
+    if target_format == 'PNG':
+        image.save(output, format='PNG', optimize=True)
+    else:
+        image.save(output, format=target_format, quality=quality)
+    normalized = output.getvalue()
+
+    if len(normalized) >= len(data) and not too_large and orientation == 1:
+        # Le MPO dei telefoni sono JPEG con fotogrammi aggiuntivi: l'originale si registra come JPEG
+        return data, 'JPEG' if source_format == 'MPO' else source_format
+    return normalized, target_format
+
+
+def prepare_image(source, policy):
+    """Eseguita nel pool di worker: restituisce (dati, formato, dimensione originale, hash percettivi)"""
+    if isinstance(source, Image.Image):
+        buffer = io.BytesIO()
+        source.save(buffer, format='PNG')
+        source = buffer.getvalue()
+
+    if policy is None:
+        data, image_format = source, Image.open(io.BytesIO(source)).format
+    else:
+        data, image_format = normalize_image(source, policy['max_side'], policy['format'], policy['quality'])
+    return data, image_format, len(source), perceptual_hashes(data)
+
+
+IMAGE_SIMILARITY_THRESHOLD = 10
+HASH_SIZE = 8
+PHASH_SAMPLE = 32
+DCT_MATRIX = np.cos(np.pi * np.outer(np.arange(PHASH_SAMPLE), 2 * np.arange(PHASH_SAMPLE) + 1) / (2 * PHASH_SAMPLE))
+
+
+def _bits_to_int(bits):
+    """64 bit -> intero con segno, salvabile in una colonna INTEGER di SQLite"""
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big', signed=True)
+
+
+def _grayscale(image, size):
+    return np.asarray(image.convert('L').resize(size, Image.Resampling.LANCZOS), dtype=np.float64)
+
+
+def perceptual_hashes(data):
+    """(dHash, pHash) a 64 bit di un'immagine, calcolati su versioni ridotte in scala di grigi"""
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (PHASH_SAMPLE * 4, PHASH_SAMPLE * 4))
+
+    pixels = _grayscale(image, (HASH_SIZE + 1, HASH_SIZE))
+    dhash = _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+    pixels = _grayscale(image, (PHASH_SAMPLE, PHASH_SAMPLE))
+    low_freq = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    phash = _bits_to_int(low_freq > np.median(low_freq.flatten()[1:]))
+    return dhash, phash
+
+
+def hamming_distance(first, second):
+    return bin((first ^ second) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class MultiIndexHash:
+    """Ricerca per distanza di Hamming su hash a 64 bit con indici su 4 blocchi da 16 bit.
+
+    Se due hash distano al massimo r, almeno un blocco dista al massimo r // 4: basta sondare
+    ogni tabella con le varianti del blocco entro quel raggio e verificare i candidati.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.CHUNKS)]
+        self.values = {}
+        self._masks = {}
+
+    def _chunks(self, value):
+        value &= 0xFFFFFFFFFFFFFFFF
+        return [(value >> (self.CHUNK_BITS * i)) & 0xFFFF for i in range(self.CHUNKS)]
+
+    def _probe_masks(self, radius):
+        if radius not in self._masks:
+            masks = []
+            for bits in range(radius + 1):
+                for positions in itertools.combinations(range(self.CHUNK_BITS), bits):
+                    masks.append(sum(1 << p for p in positions))
+            self._masks[radius] = masks
+        return self._masks[radius]
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value, key):
+        self.values[key] = value
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table.setdefault(chunk, set()).add(key)
+
+    def search(self, value, max_distance):
+        masks = self._probe_masks(max_distance // self.CHUNKS)
+        candidates = set()
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+
+        results = []
+        for key in candidates:
+            distance = hamming_distance(value, self.values[key])
+            if distance <= max_distance:
+                results.append((distance, key))
+        return results
+
+
+DAY_SECONDS = 24 * 3600
+RECURRENCE_WINDOW_DAYS = 30
+RATE_WINDOW_DAYS = 90
+
+
+RECORD_CODED_COLUMNS = ('macchina', 'categoria', 'operatore')
+RECORD_TEXT_COLUMNS = ('problema', 'soluzione')
+ATTACHMENT_TYPES = ('image', 'txt', 'docx')
+RECORD_ATTACHMENT_COUNTS_SQL = ', '.join(
+    f"(SELECT COUNT(*) FROM allegati a WHERE a.intervento_id = i.id AND a.tipo_file = '{tipo}')"
+    for tipo in ATTACHMENT_TYPES)
+
+
+class RecordCache:
+    """Cache colonnare degli interventi, unica e condivisa da elenco, ricerca, filtri, IA, statistiche ed export.
+
+    Macchina, categoria e operatore sono codici interi su tabelle di valori unici, data_ora e' in secondi epoch
+    e i conteggi degli allegati per tipo in array NumPy. I testi di ogni colonna stanno in un solo buffer UTF-8
+    (righe separate da un byte nullo) indirizzato per offset, caricato al primo utilizzo della colonna.
+    Chi deriva dati dalle righe si registra in listeners e riceve records_appended / records_removed.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.codes = {column: np.empty(0, dtype=np.int32) for column in RECORD_CODED_COLUMNS}
+        self.values = {column: [] for column in RECORD_CODED_COLUMNS}
+        self.value_index = {column: {} for column in RECORD_CODED_COLUMNS}
+        self.attachment_counts = np.empty((0, len(ATTACHMENT_TYPES)), dtype=np.int32)
+        self.texts = {}
+        self.text_offsets = {}
+        self.text_lengths = {}
+        self.text_garbage = {}
+        self.listeners = []
+        self.max_id = 0
+        self.version = 0
+
+    @staticmethod
+    def _intern(value, names, index):
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(names)
+            names.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _select(self, where):
+        text_columns = ''.join(f', i.{column}' for column in self.texts)
+        return f'''
+            SELECT i.id, i.data_ora, i.macchina, i.categoria, i.operatore, {RECORD_ATTACHMENT_COUNTS_SQL}{text_columns}
+            FROM interventi i WHERE {where} ORDER BY i.id
+        '''
+
+    def refresh(self, conn):
+        """Carica solo le righe con id maggiore dell'ultimo gia' in memoria"""
+        self._append(conn.execute(self._select('i.id > ?'), (self.max_id,)).fetchall())
+
+    def reload_rows(self, conn, ids):
+        """Rilegge righe gia' presenti (es. cambio di macchina o categoria)"""
+        ids = list(ids)
+        if not ids:
+            return
+        self.remove(ids)
+        placeholders = ', '.join('?' * len(ids))
+        self._append(conn.execute(self._select(f'i.id IN ({placeholders})'), ids).fetchall())
+
+    def _append(self, rows):
+        if not rows:
+            return
+        start = len(self.ids)
+        columns = list(zip(*rows))
+        ids, dates = columns[0], columns[1]
+        try:
+            timestamps = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+        except ValueError:
+            timestamps = np.array([int(datetime.fromisoformat(d).replace(tzinfo=timezone.utc).timestamp()) for d in dates],
+                                  dtype=np.int64)
+
+        self.ids = np.concatenate((self.ids, np.array(ids, dtype=np.int64)))
+        self.timestamps = np.concatenate((self.timestamps, timestamps))
+        for column, values in zip(RECORD_CODED_COLUMNS, columns[2:5]):
+            names, index = self.values[column], self.value_index[column]
+            self.codes[column] = np.concatenate((self.codes[column], np.array(
+                [self._intern(value, names, index) for value in values], dtype=np.int32)))
+        text_start = 5 + len(ATTACHMENT_TYPES)
+        self.attachment_counts = np.concatenate((self.attachment_counts,
+                                                 np.array(columns[5:text_start], dtype=np.int32).T))
+        for column, texts in zip(list(self.texts), columns[text_start:]):
+            self._append_text(column, texts)
+        self.max_id = max(self.max_id, int(self.ids.max()))
+        self.version += 1
+        for listener in self.listeners:
+            listener.records_appended(start, len(self.ids))
+
+    def _append_text(self, column, texts):
+        encoded = [text.encode('utf-8') for text in texts]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        buffer = self.texts[column]
+        offsets = len(buffer) + np.concatenate(([0], np.cumsum(lengths + 1)[:-1])).astype(np.int64)
+        buffer += b'\0'.join(encoded) + b'\0'
+        self.text_offsets[column] = np.concatenate((self.text_offsets[column], offsets))
+        self.text_lengths[column] = np.concatenate((self.text_lengths[column], lengths))
+
+    def remove(self, ids):
+        if not len(ids) or not len(self.ids):
+            return
+        removed = np.isin(self.ids, np.asarray(list(ids), dtype=np.int64))
+        if not removed.any():
+            return
+        for listener in self.listeners:
+            listener.records_removed(np.flatnonzero(removed))
+
+        keep = ~removed
+        self.ids = self.ids[keep]
+        self.timestamps = self.timestamps[keep]
+        for column in RECORD_CODED_COLUMNS:
+            self.codes[column] = self.codes[column][keep]
+        self.attachment_counts = self.attachment_counts[keep]
+        for column in self.texts:
+            self.text_garbage[column] += int((self.text_lengths[column][removed] + 1).sum())
+            self.text_offsets[column] = self.text_offsets[column][keep]
+            self.text_lengths[column] = self.text_lengths[column][keep]
+            if self.text_garbage[column] > len(self.texts[column]) // 2:
+                self._compact_text(column)
+        self.version += 1
+
+    def _compact_text(self, column):
+        buffer, offsets, lengths = self.texts[column], self.text_offsets[column], self.text_lengths[column]
+        self.texts[column] = bytearray()
+        self.text_offsets[column] = np.empty(0, dtype=np.int64)
+        self.text_lengths[column] = np.empty(0, dtype=np.int64)
+        self.text_garbage[column] = 0
+        self._append_text(column, [bytes(buffer[o:o + n]).decode('utf-8') for o, n in zip(offsets, lengths)])
+
+    def load_text(self, conn, *columns):
+        """Carica i testi delle colonne indicate, se non sono gia' in memoria"""
+        for column in columns:
+            if column in self.texts:
+                continue
+            self.texts[column] = bytearray()
+            self.text_offsets[column] = np.empty(0, dtype=np.int64)
+            self.text_lengths[column] = np.empty(0, dtype=np.int64)
+            self.text_garbage[column] = 0
+            if len(self.ids):
+                by_id = dict(conn.execute(f'SELECT id, {column} FROM interventi'))
+                self._append_text(column, [by_id.get(record_id, '') for record_id in self.ids.tolist()])
+
+    def text(self, column, row):
+        offset = self.text_offsets[column][row]
+        return self.texts[column][offset:offset + self.text_lengths[column][row]].decode('utf-8')
+
+    def value(self, column, row):
+        return self.values[column][self.codes[column][row]]
+
+    def date_strings(self, rows):
+        return [d.replace('T', ' ') for d in np.datetime_as_string(self.timestamps[rows].astype('datetime64[s]'))]
+
+    def by_date_desc(self, rows):
+        return rows[np.argsort(-self.timestamps[rows], kind='stable')]
+
+    def text_matches(self, term):
+        """Righe in cui problema, soluzione o macchina contengono term, ignorando maiuscole ASCII come LIKE"""
+        mask = np.zeros(len(self.ids), dtype=bool)
+        pattern = re.compile(re.escape(term.encode('utf-8')), re.IGNORECASE)
+        for column in RECORD_TEXT_COLUMNS:
+            positions = np.fromiter((m.start() for m in pattern.finditer(self.texts[column])), dtype=np.int64)
+            if len(positions):
+                # Gli offset crescono con l'indice di riga; le occorrenze nello spazio liberato non cadono in nessuna riga
+                rows = np.searchsorted(self.text_offsets[column], positions, side='right') - 1
+                ends = self.text_offsets[column] + self.text_lengths[column]
+                valid = (rows >= 0) & (positions < ends[np.clip(rows, 0, None)])
+                mask[rows[valid]] = True
+        term = term.lower()
+        matching = [code for code, name in enumerate(self.values['macchina']) if term in name.lower()]
+        if matching:
+            mask |= np.isin(self.codes['macchina'], matching)
+        return mask
+
+
+class ReliabilityAnalytics:
+    """Statistiche di affidabilita' calcolate in NumPy sulle colonne della cache condivisa degli interventi"""
+
+    def __init__(self, records):
+        self.records = records
+        self._cache_store = {}
+        self._cache_version = -1
+
+    @property
+    def _cache(self):
+        if self._cache_version != self.records.version:
+            self._cache_store = {}
+            self._cache_version = self.records.version
+        return self._cache_store
+
+    @property
+    def ids(self):
+        return self.records.ids
+
+    @property
+    def timestamps(self):
+        return self.records.timestamps
+
+    @property
+    def machine_codes(self):
+        return self.records.codes['macchina']
+
+    @property
+    def category_codes(self):
+        return self.records.codes['categoria']
+
+    @property
+    def machines(self):
+        return self.records.values['macchina']
+
+    @property
+    def machine_index(self):
+        return self.records.value_index['macchina']
+
+    @property
+    def categories(self):
+        return self.records.values['categoria']
+
+    def __len__(self):
+        return len(self.records)
+
+    def category_counts(self):
+        counts = np.bincount(self.category_codes, minlength=len(self.categories))
+        order = np.argsort(-counts, kind='stable')
+        return [(self.categories[i], int(counts[i])) for i in order if counts[i]]
+
+    def machine_counts(self, limit=None):
+        counts = np.bincount(self.machine_codes, minlength=len(self.machines))
+        order = np.argsort(-counts, kind='stable')[:limit]
+        return [(self.machines[i], int(counts[i])) for i in order if counts[i]]
+
+    def monthly_counts(self, months=12):
+        """Ultimi N mesi con almeno un intervento, in ordine cronologico"""
+        month_index = self.timestamps.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+        present, counts = np.unique(month_index, return_counts=True)
+        present, counts = present[-months:], counts[-months:]
+        labels = np.datetime_as_string(present.astype('datetime64[M]'), unit='M')
+        return [str(label) for label in labels], [int(c) for c in counts]
+
+    def inter_failure_gaps(self):
+        """Intervalli (secondi) tra interventi consecutivi sulla stessa macchina, con la macchina relativa"""
+        if 'gaps' not in self._cache:
+            order = np.lexsort((self.timestamps, self.machine_codes))
+            machines = self.machine_codes[order]
+            same_machine = machines[1:] == machines[:-1]
+            gaps = np.diff(self.timestamps[order])[same_machine]
+            self._cache['gaps'] = (gaps, machines[1:][same_machine])
+        return self._cache['gaps']
+
+    def machine_summary(self, now=None):
+        """MTBF, distribuzione degli intervalli, ricorrenza e tassi recenti per ogni macchina"""
+        now = int(now if now is not None else np.datetime64(datetime.now().replace(microsecond=0), 's').astype(np.int64))
+        key = ('summary', now // 3600)
+        if key in self._cache:
+            return self._cache[key]
+
+        n_machines = len(self.machines)
+        n_categories = max(len(self.categories), 1)
+        totals = np.bincount(self.machine_codes, minlength=n_machines)
+
+        gaps, gap_machines = self.inter_failure_gaps()
+        gap_counts = np.bincount(gap_machines, minlength=n_machines)
+        gap_sums = np.bincount(gap_machines, weights=gaps, minlength=n_machines)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mtbf_days = gap_sums / gap_counts / DAY_SECONDS
+
+        # Mediana e 90° percentile per gruppo: ordinamento per (macchina, intervallo) e indici nei segmenti
+        order = np.lexsort((gaps, gap_machines))
+        sorted_gaps = gaps[order]
+        starts = np.concatenate(([0], np.cumsum(gap_counts)[:-1]))
+        has_gaps = gap_counts > 0
+        median_days = np.full(n_machines, np.nan)
+        p90_days = np.full(n_machines, np.nan)
+        median_days[has_gaps] = sorted_gaps[starts[has_gaps] + (gap_counts[has_gaps] - 1) // 2] / DAY_SECONDS
+        p90_days[has_gaps] = sorted_gaps[starts[has_gaps] + ((gap_counts[has_gaps] - 1) * 9) // 10] / DAY_SECONDS
+
+        # Ricorrenza: stesso guasto (macchina + categoria) ripresentato entro la finestra
+        pair = self.machine_codes.astype(np.int64) * n_categories + self.category_codes
+        order = np.lexsort((self.timestamps, pair))
+        sorted_pair = pair[order]
+        recurring = (sorted_pair[1:] == sorted_pair[:-1]) & \
+                    (np.diff(self.timestamps[order]) <= RECURRENCE_WINDOW_DAYS * DAY_SECONDS)
+        recurrences = np.bincount(sorted_pair[1:][recurring] // n_categories, minlength=n_machines)
+
+        # Tasso mensile negli ultimi 90 giorni e nei 90 precedenti
+        age_days = (now - self.timestamps) // DAY_SECONDS
+        recent = np.bincount(self.machine_codes[(age_days >= 0) & (age_days < RATE_WINDOW_DAYS)], minlength=n_machines)
+        previous = np.bincount(self.machine_codes[(age_days >= RATE_WINDOW_DAYS) & (age_days < 2 * RATE_WINDOW_DAYS)],
+                               minlength=n_machines)
+        per_month = 30 / RATE_WINDOW_DAYS
+
+        summary = []
+        for code in np.argsort(-totals, kind='stable'):
+            if not totals[code]:
+                continue
+            summary.append({
+                'macchina': self.machines[code],
+                'interventi': int(totals[code]),
+                'mtbf_giorni': float(mtbf_days[code]),
+                'mediana_giorni': float(median_days[code]),
+                'p90_giorni': float(p90_days[code]),
+                'ricorrenze': int(recurrences[code]),
+                'ricorrenza_pct': 100.0 * float(recurrences[code]) / float(totals[code]),
+                'tasso_recente': float(recent[code]) * per_month,
+                'tasso_precedente': float(previous[code]) * per_month,
+            })
+        self._cache[key] = summary
+        return summary
+
+    def rolling_rate(self, weeks=26, window=4, now=None):
+        """Interventi per settimana (media mobile su window settimane) per ogni macchina: matrice macchine x settimane"""
+        now = int(now if now is not None else np.datetime64(datetime.now().replace(microsecond=0), 's').astype(np.int64))
+        week = (now - self.timestamps) // (7 * DAY_SECONDS)
+        mask = (week >= 0) & (week < weeks + window - 1)
+        n_weeks = weeks + window - 1
+        counts = np.bincount(self.machine_codes[mask].astype(np.int64) * n_weeks + (n_weeks - 1 - week[mask]),
+                             minlength=len(self.machines) * n_weeks).reshape(len(self.machines), n_weeks)
+        cumulative = np.cumsum(np.pad(counts, ((0, 0), (1, 0))), axis=1)
+        return (cumulative[:, window:] - cumulative[:, :-window]) / window
+
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_SHINGLE_SIZE = 4
+DUPLICATE_THRESHOLD = 0.7
+
+
+class MinHashIndex:
+    """Firme MinHash dei testi 'problema' con indice LSH a bande: ricerca dei quasi-duplicati in tempo costante"""
+
+    def __init__(self, permutations=MINHASH_PERMUTATIONS, bands=MINHASH_BANDS):
+        rng = np.random.default_rng(20240101)  # seme fisso: le firme salvate restano confrontabili
+        self.a = rng.integers(0, 1 << 64, size=permutations, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 64, size=permutations, dtype=np.uint64)
+        self.bands = bands
+        self.rows_per_band = permutations // bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+        self.machines = {}
+
+    @staticmethod
+    def shingles(text):
+        normalized = ' '.join(re.findall(r'\w+', text.lower()))
+        if len(normalized) <= MINHASH_SHINGLE_SIZE:
+            return {normalized}
+        return {normalized[i:i + MINHASH_SHINGLE_SIZE] for i in range(len(normalized) - MINHASH_SHINGLE_SIZE + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)), dtype=np.uint64)
+        # Hash multiply-shift: (a*x + b) mod 2^64 con a dispari, tenendo i 32 bit alti
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        step = self.rows_per_band
+        return [signature[i * step:(i + 1) * step].tobytes() for i in range(self.bands)]
+
+    def add(self, record_id, signature, machine):
+        self.remove(record_id)
+        self.signatures[record_id] = signature
+        self.machines[record_id] = machine.strip().lower()
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(key, set()).add(record_id)
+
+    def remove(self, record_id):
+        signature = self.signatures.pop(record_id, None)
+        if signature is None:
+            return
+        self.machines.pop(record_id, None)
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            members = bucket.get(key)
+            if members:
+                members.discard(record_id)
+                if not members:
+                    del bucket[key]
+
+    def candidates(self, signature):
+        found = set()
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            found.update(bucket.get(key, ()))
+        return found
+
+    def similarity(self, first, second):
+        return float(np.mean(first == second))
+
+    def best_duplicate(self, signature, machine, threshold=DUPLICATE_THRESHOLD):
+        """Intervento piu' simile sulla stessa macchina, oppure None"""
+        machine = machine.strip().lower()
+        best = None
+        for record_id in self.candidates(signature):
+            if self.machines[record_id] != machine:
+                continue
+            score = self.similarity(signature, self.signatures[record_id])
+            if score >= threshold and (best is None or score > best[1]):
+                best = (record_id, score)
+        return best
+
+    def duplicate_clusters(self, threshold=DUPLICATE_THRESHOLD):
+        """Gruppi di interventi quasi-duplicati (stessa macchina) tramite union-find sulle coppie candidate"""
+        parent = {}
+
+        def find(x):
+            while parent.get(x, x) != x:
+                parent[x] = parent.get(parent[x], parent[x])
+                x = parent[x]
+            return x
+
+        for bucket in self.buckets:
+            for members in bucket.values():
+                if len(members) < 2:
+                    continue
+                # Confronto con il primo membro del secchio: lineare anche per secchi molto grandi
+                ordered = sorted(members)
+                head = ordered[0]
+                for record_id in ordered[1:]:
+                    if find(record_id) == find(head) or self.machines[record_id] != self.machines[head]:
+                        continue
+                    if self.similarity(self.signatures[head], self.signatures[record_id]) >= threshold:
+                        parent[find(record_id)] = find(head)
+
+        clusters = {}
+        for record_id in parent:
+            clusters.setdefault(find(record_id), set()).add(record_id)
+        for root in list(clusters):
+            clusters[root].add(root)
+        return sorted((sorted(members) for members in clusters.values()), key=lambda c: (-len(c), c[0]))
+
+
+def duplicate_clusters_job(db_path, signatures, machines):
+    """Job nel pool di worker: ricostruisce l'indice da una copia delle firme e legge le righe di ogni gruppo"""
+    index = MinHashIndex()
+    for record_id, signature in signatures.items():
+        index.add(record_id, signature, machines[record_id])
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        groups = []
+        for cluster in index.duplicate_clusters():
+            placeholders = ', '.join('?' * len(cluster))
+            rows = conn.execute(f'''
+                SELECT id, data_ora, macchina, problema FROM interventi WHERE id IN ({placeholders}) ORDER BY data_ora, id
+            ''', cluster).fetchall()
+            # Interventi eliminati dopo la copia delle firme
+            if len(rows) > 1:
+                groups.append(rows)
+        return groups
+    finally:
+        conn.close()
+
+
+def build_minhash_index(db_path):
+    """Job nel pool di worker: calcola le firme mancanti e costruisce l'indice con una connessione propria"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        index = MinHashIndex()
+        missing = conn.execute('''
+            SELECT i.id, i.problema FROM interventi i
+            LEFT JOIN minhash_firme f ON f.intervento_id = i.id
+            WHERE f.intervento_id IS NULL
+        ''').fetchall()
+        if missing:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO minhash_firme (intervento_id, firma) VALUES (?, ?)',
+                                 [(record_id, index.signature(problema).tobytes()) for record_id, problema in missing])
+
+        for record_id, firma, macchina in conn.execute('''
+            SELECT f.intervento_id, f.firma, i.macchina FROM minhash_firme f JOIN interventi i ON i.id = f.intervento_id
+        '''):
+            index.add(record_id, np.frombuffer(firma, dtype=np.uint32), macchina)
+        return index
+    finally:
+        conn.close()
+
+
+CLUSTER_FEATURES = 4096
+CLUSTER_CHUNK_SIZE = 1000
+CLUSTER_MAX_K = 40
+CLUSTER_LLOYD_ITERATIONS = 5
+CLUSTER_MIN_SIMILARITY = 0.25
+CLUSTER_MERGE_SIMILARITY = 0.6
+CLUSTER_MIN_SIZE = 3
+CLUSTER_LABEL_TERMS = 4
+
+ITALIAN_STOPWORDS = frozenset('''
+    il lo la gli le un una uno di da in con su per tra fra non che chi del dello della dei degli delle
+    al allo alla ai agli alle dal dallo dalla dai dagli dalle nel nello nella nei negli nelle sul sullo
+    sulla sui sugli sulle come anche piu poi dopo quando mentre sono era erano stato stata essere avere
+    hanno abbiamo questo questa questi queste quello quella quelli ogni tutto tutti tutta tutte sempre
+    ancora dove perche quindi cosi gia solo molto volta volte fatto fare viene vengono
+'''.split())
+
+
+def fault_tokens(text):
+    return [word for word in re.findall(r'[^\W\d_]{3,}', text.lower()) if word not in ITALIAN_STOPWORDS]
+
+
+class FaultClusterer:
+    """K-means sferico su vettori TF-IDF con hashing di problema+soluzione, a blocchi e in memoria limitata"""
+
+    def __init__(self, conn, chunk_size=CLUSTER_CHUNK_SIZE, features=CLUSTER_FEATURES):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.features = features
+        self.rng = np.random.default_rng(0)
+        self.idf = None
+        self.centers = None
+
+    def iter_chunks(self):
+        last_id = 0
+        while True:
+            rows = self.conn.execute('''
+                SELECT id, problema || ' ' || soluzione FROM interventi WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, self.chunk_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield rows
+
+    def _feature(self, token):
+        return zlib.crc32(token.encode('utf-8')) % self.features
+
+    def fit_idf(self):
+        document_frequency = np.zeros(self.features, dtype=np.int64)
+        total = 0
+        for rows in self.iter_chunks():
+            for _, text in rows:
+                features = {self._feature(token) for token in fault_tokens(text)}
+                document_frequency[list(features)] += 1
+            total += len(rows)
+        self.idf = (np.log((1 + total) / (1 + document_frequency)) + 1).astype(np.float32)
+        return total
+
+    def vectorize(self, rows):
+        """Matrice TF-IDF normalizzata (righe x feature) per un blocco di interventi"""
+        matrix = np.zeros((len(rows), self.features), dtype=np.float32)
+        for row_index, (_, text) in enumerate(rows):
+            features = [self._feature(token) for token in fault_tokens(text)]
+            if features:
+                np.add.at(matrix[row_index], features, 1)
+        np.log1p(matrix, out=matrix)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix, norms[:, 0] > 0
+
+    def _init_centers(self, k):
+        """k-means++ sul primo blocco con almeno un intervento vettorizzabile"""
+        for rows in self.iter_chunks():
+            matrix, valid = self.vectorize(rows)
+            matrix = matrix[valid]
+            if len(matrix):
+                break
+        else:
+            self.centers = np.zeros((0, self.features), dtype=np.float32)
+            return
+        centers = [matrix[self.rng.integers(len(matrix))]]
+        for _ in range(1, k):
+            distance = 1 - np.max(matrix @ np.array(centers).T, axis=1)
+            weights = np.clip(distance, 0, None) ** 2
+            if weights.sum() == 0:
+                break
+            centers.append(matrix[self.rng.choice(len(matrix), p=weights / weights.sum())])
+        self.centers = np.array(centers, dtype=np.float32)
+
+    def _normalize_centers(self):
+        norms = np.linalg.norm(self.centers, axis=1, keepdims=True)
+        np.divide(self.centers, norms, out=self.centers, where=norms > 0)
+
+    def fit(self, total):
+        k = min(CLUSTER_MAX_K, max(2, int(np.sqrt(total / 2))))
+        self._init_centers(k)
+        k = len(self.centers)
+        if not k:
+            return
+
+        # Primo passaggio mini-batch (media mobile), poi iterazioni di Lloyd accumulate a blocchi
+        counts = np.zeros(k)
+        for rows in self.iter_chunks():
+            matrix, valid = self.vectorize(rows)
+            matrix = matrix[valid]
+            sums, batch_counts = self._accumulate(matrix)
+            updated = batch_counts > 0
+            new_counts = counts + batch_counts
+            self.centers[updated] = ((self.centers[updated] * counts[updated, None] + sums[updated])
+                                     / new_counts[updated, None])
+            counts = new_counts
+            self._normalize_centers()
+
+        for _ in range(CLUSTER_LLOYD_ITERATIONS):
+            sums = np.zeros_like(self.centers)
+            counts = np.zeros(k)
+            for rows in self.iter_chunks():
+                matrix, valid = self.vectorize(rows)
+                batch_sums, batch_counts = self._accumulate(matrix[valid])
+                sums += batch_sums
+                counts += batch_counts
+            previous = self.centers.copy()
+            updated = counts > 0
+            self.centers[updated] = sums[updated]
+            self._normalize_centers()
+            if np.max(np.abs(self.centers - previous)) < 1e-4:
+                break
+        self._merge_centers(counts)
+
+    def _merge_centers(self, counts):
+        """Agglomerativo sui centroidi: unisce le coppie piu' simili finche' superano la soglia"""
+        # I centroidi rimasti senza interventi non rappresentano nessun guasto
+        kept = counts > 0
+        centers = list(self.centers[kept] * counts[kept, None])
+        counts = list(counts[kept])
+        while len(centers) > 1:
+            matrix = np.array(centers)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+            similarity = matrix @ matrix.T
+            np.fill_diagonal(similarity, -1)
+            first, second = np.unravel_index(np.argmax(similarity), similarity.shape)
+            if similarity[first, second] < CLUSTER_MERGE_SIMILARITY:
+                break
+            centers[first] = centers[first] + centers[second]
+            counts[first] += counts[second]
+            del centers[second], counts[second]
+        self.centers = np.array(centers, dtype=np.float32)
+        self._normalize_centers()
+
+    def _accumulate(self, matrix):
+        labels = np.argmax(matrix @ self.centers.T, axis=1)
+        one_hot = np.zeros((len(matrix), len(self.centers)), dtype=np.float32)
+        one_hot[np.arange(len(matrix)), labels] = 1
+        return one_hot.T @ matrix, one_hot.sum(axis=0)
+
+    def assign(self):
+        """Assegnazione finale: (id, cluster, similarita') e termini piu' frequenti per cluster"""
+        assignments = []
+        term_counts = [{} for _ in range(len(self.centers))]
+        for rows in self.iter_chunks():
+            matrix, valid = self.vectorize(rows)
+            similarities = matrix @ self.centers.T
+            labels = np.argmax(similarities, axis=1)
+            best = similarities[np.arange(len(rows)), labels]
+            for (record_id, text), label, score, is_valid in zip(rows, labels, best, valid):
+                if not is_valid or score < CLUSTER_MIN_SIMILARITY:
+                    continue
+                assignments.append((record_id, int(label), float(score)))
+                counts = term_counts[label]
+                for token in fault_tokens(text):
+                    counts[token] = counts.get(token, 0) + 1
+
+        labels = []
+        for counts in term_counts:
+            ranked = sorted(counts, key=lambda token: -counts[token] * self.idf[self._feature(token)])
+            labels.append(', '.join(ranked[:CLUSTER_LABEL_TERMS]))
+        return assignments, labels
+
+
+def cluster_interventions(db_path):
+    """Job batch eseguito nel pool di worker con una connessione propria"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        clusterer = FaultClusterer(conn)
+        total = clusterer.fit_idf()
+        if total < CLUSTER_MIN_SIZE:
+            return {'total': total, 'clusters': 0, 'assigned': 0}
+
+        clusterer.fit(total)
+        if not len(clusterer.centers):
+            return {'total': total, 'clusters': 0, 'assigned': 0}
+        assignments, labels = clusterer.assign()
+
+        sizes = np.bincount([label for _, label, _ in assignments], minlength=len(labels))
+        recurring = {label for label in range(len(labels)) if sizes[label] >= CLUSTER_MIN_SIZE}
+        created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        with conn:
+            conn.execute('DELETE FROM interventi_cluster')
+            conn.execute('DELETE FROM cluster_guasti')
+            conn.executemany('INSERT INTO cluster_guasti (id, etichetta, dimensione, creato_il) VALUES (?, ?, ?, ?)',
+                             [(label, labels[label], int(sizes[label]), created) for label in sorted(recurring)])
+            conn.executemany('INSERT INTO interventi_cluster (intervento_id, cluster_id, similarita) VALUES (?, ?, ?)',
+                             [row for row in assignments if row[1] in recurring])
+        return {'total': total, 'clusters': len(recurring),
+                'assigned': sum(int(sizes[label]) for label in recurring)}
+    finally:
+        conn.close()
+
+
+FACET_COLUMNS = RECORD_CODED_COLUMNS
+FACET_ATTACHMENT_LABELS = {'image': 'Immagini', 'txt': 'File TXT', 'docx': 'File DOCX'}
+
+
+class FacetIndex:
+    """Conteggi dei filtri (macchina, categoria, operatore, tipo allegato) aggiornati per differenza.
+
+    Lavora sulle colonne della RecordCache: un cambio di filtro ricalcola i conteggi con bincount,
+    un inserimento o una cancellazione aggiunge o toglie solo il contributo delle righe toccate.
+    """
+
+    FACETS = FACET_COLUMNS + ('allegato',)
+
+    def __init__(self, records):
+        self.records = records
+        self.filters = {facet: None for facet in self.FACETS}
+        self.date_from = None
+        self.date_to = None
+        self.counts = {}
+        records.listeners.append(self)
+
+    def records_appended(self, start, end):
+        if self.counts:
+            self._accumulate(np.arange(start, end), 1)
+
+    def records_removed(self, rows):
+        if self.counts:
+            self._accumulate(rows, -1)
+
+    def _matches(self, rows, exclude=None):
+        """Maschera delle righe che rispettano tutti i filtri tranne quello escluso"""
+        records = self.records
+        mask = np.ones(len(rows), dtype=bool)
+        for facet in FACET_COLUMNS:
+            value = self.filters[facet]
+            if facet != exclude and value is not None:
+                mask &= records.codes[facet][rows] == records.value_index[facet].get(value, -1)
+        value = self.filters['allegato']
+        if exclude != 'allegato' and value is not None:
+            mask &= records.attachment_counts[rows, ATTACHMENT_TYPES.index(value)] > 0
+        if self.date_from is not None:
+            mask &= records.timestamps[rows] >= self.date_from
+        if self.date_to is not None:
+            mask &= records.timestamps[rows] < self.date_to
+        return mask
+
+    def matching_rows(self):
+        """Indici (nella RecordCache) delle righe che rispettano tutti i filtri attivi"""
+        rows = np.arange(len(self.records))
+        return rows[self._matches(rows)]
+
+    def _accumulate(self, rows, sign):
+        for facet in self.FACETS:
+            selected = rows[self._matches(rows, exclude=facet)]
+            if facet == 'allegato':
+                delta = np.count_nonzero(self.records.attachment_counts[selected] > 0, axis=0)
+            else:
+                delta = np.bincount(self.records.codes[facet][selected], minlength=len(self.records.values[facet]))
+            counts = self.counts[facet]
+            if len(delta) > len(counts):
+                counts = np.concatenate((counts, np.zeros(len(delta) - len(counts), dtype=counts.dtype)))
+            counts[:len(delta)] += sign * delta
+            self.counts[facet] = counts
+
+    def recount(self):
+        self.counts = {facet: np.zeros(len(self.records.values.get(facet, ATTACHMENT_TYPES)), dtype=np.int64)
+                       for facet in self.FACETS}
+        self._accumulate(np.arange(len(self.records)), 1)
+
+    def set_filter(self, facet, value):
+        self.filters[facet] = value
+        self.recount()
+
+    def set_date_range(self, date_from, date_to):
+        self.date_from, self.date_to = date_from, date_to
+        self.recount()
+
+    def facet_counts(self, facet):
+        """[(valore, conteggio)] ordinati per conteggio, tenendo conto degli altri filtri attivi"""
+        if not self.counts:
+            self.recount()
+        names = ATTACHMENT_TYPES if facet == 'allegato' else self.records.values[facet]
+        counts = self.counts[facet]
+        order = np.argsort(-counts, kind='stable')
+        return [(names[i], int(counts[i])) for i in order if counts[i] or names[i] == self.filters[facet]]
+
+    def sql_filter(self, alias='interventi'):
+        """Clausola WHERE (con parametri) equivalente ai filtri attivi, da usare nelle query"""
+        clauses, params = [], []
+        for facet in FACET_COLUMNS:
+            if self.filters[facet] is not None:
+                clauses.append(f'{alias}.{facet} = ?')
+                params.append(self.filters[facet])
+        if self.date_from is not None:
+            clauses.append(f'{alias}.data_ora >= ?')
+            params.append(datetime.fromtimestamp(self.date_from, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+        if self.date_to is not None:
+            clauses.append(f'{alias}.data_ora < ?')
+            params.append(datetime.fromtimestamp(self.date_to, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+        if self.filters['allegato'] is not None:
+            clauses.append(f'EXISTS (SELECT 1 FROM allegati a WHERE a.intervento_id = {alias}.id AND a.tipo_file = ?)')
+            params.append(self.filters['allegato'])
+        return ' AND '.join(clauses) or '1', params
+
+    def describe(self):
+        parts = [f"{facet}={self.filters[facet]}" for facet in FACET_COLUMNS if self.filters[facet] is not None]
+        if self.filters['allegato'] is not None:
+            parts.append(f"allegati={FACET_ATTACHMENT_LABELS[self.filters['allegato']]}")
+        if self.date_from is not None:
+            parts.append(f"dal {datetime.fromtimestamp(self.date_from, timezone.utc):%Y-%m-%d}")
+        if self.date_to is not None:
+            parts.append(f"al {datetime.fromtimestamp(self.date_to - DAY_SECONDS, timezone.utc):%Y-%m-%d}")
+        return ', '.join(parts)
+
+
+GALLERY_TILE_SIZE = 240
+GALLERY_TILE_PADDING = 10
+GALLERY_CAPTION_HEIGHT = 24
+GALLERY_PREFETCH_ROWS = 2
+GALLERY_CACHE_SIZE = 48
+GALLERY_VIEWER_SIZE = 800
+
+
+def iter_blob_chunks(conn, allegato_id):
+    """Legge e decomprime un allegato a blocchi dalla connessione indicata"""
+    row = conn.execute('SELECT codec FROM allegati WHERE id = ?', (allegato_id,)).fetchone()
+    if row is None:
+        return
+
+    if hasattr(conn, 'blobopen'):
+        with conn.blobopen('allegati', 'contenuto', allegato_id, readonly=True) as blob:
+            yield from iter_decompressed(row[0], iter(lambda: blob.read(CHUNK_SIZE), b''))
+    else:
+        contenuto = conn.execute('SELECT contenuto FROM allegati WHERE id = ?', (allegato_id,)).fetchone()[0]
+        yield from iter_decompressed(row[0], [contenuto])
+
+
+IMAGE_BACKFILL_BATCH_SIZE = 20
+
+
+def backfill_image_hashes_job(db_path, progress=None):
+    """Job nel pool di worker: calcola dHash/pHash delle immagini che ne sono prive, con una connessione propria.
+
+    Procede a lotti per id crescente salvando dopo ogni lotto; le immagini non leggibili restano senza hash
+    e vengono saltate, cosi' il job termina sempre.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    stats = {'done': 0, 'failed': 0}
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM allegati WHERE tipo_file = 'image' AND phash IS NULL").fetchone()[0]
+        last_id = 0
+        while True:
+            rows = conn.execute('''
+                SELECT id FROM allegati WHERE tipo_file = 'image' AND phash IS NULL AND id > ? ORDER BY id LIMIT ?
+            ''', (last_id, IMAGE_BACKFILL_BATCH_SIZE)).fetchall()
+            if not rows:
+                return stats
+            last_id = rows[-1][0]
+
+            updates = []
+            for (allegato_id,) in rows:
+                try:
+                    updates.append(perceptual_hashes(b''.join(iter_blob_chunks(conn, allegato_id))) + (allegato_id,))
+                except Exception:
+                    stats['failed'] += 1
+            with conn:
+                conn.executemany('UPDATE allegati SET dhash = ?, phash = ? WHERE id = ?', updates)
+            stats['done'] += len(updates)
+            if progress:
+                progress(stats['done'] + stats['failed'], total)
+    finally:
+        conn.close()
+
+
+def collect_sync_changes(conn, since_seq, to_seq, peer):
+    """Stato attuale delle righe modificate dopo since_seq (None = tutte le righe)"""
+    if since_seq is None:
+        keys = [('interventi', row[0], None) for row in conn.execute('SELECT uuid FROM interventi ORDER BY id')]
+        keys += [('allegati', row[0], None) for row in conn.execute('SELECT uuid FROM allegati ORDER BY id')]
+    else:
+        # Una sola voce per riga, anche se modificata piu' volte: il costo dipende dalle modifiche
+        keys = conn.execute('''
+            SELECT tabella, uuid, MAX(seq) FROM registro_modifiche
+            WHERE seq > ? AND seq <= ? AND origine != ?
+            GROUP BY tabella, uuid
+            ORDER BY tabella = 'allegati', MAX(seq)
+        ''', (since_seq, to_seq, peer)).fetchall()
+
+    changes = []
+    for table, row_uuid, _ in keys:
+        if table == 'interventi':
+            row = conn.execute(f'''
+                SELECT {', '.join(SYNC_INTERVENTO_FIELDS)} FROM interventi WHERE uuid = ?
+            ''', (row_uuid,)).fetchone()
+            data = dict(zip(SYNC_INTERVENTO_FIELDS, row)) if row else None
+        else:
+            row = conn.execute('''
+                SELECT i.uuid, a.nome_file, a.tipo_file, a.hash_contenuto, a.dhash, a.phash
+                FROM allegati a JOIN interventi i ON i.id = a.intervento_id
+                WHERE a.uuid = ?
+            ''', (row_uuid,)).fetchone()
+            data = dict(zip(('intervento_uuid',) + SYNC_ALLEGATO_FIELDS + ('dhash', 'phash'), row)) if row else None
+
+        if data is None:
+            changes.append({'tabella': table, 'uuid': row_uuid, 'op': 'D'})
+        else:
+            changes.append({'tabella': table, 'uuid': row_uuid, 'op': 'U', 'dati': data})
+    return changes
+
+
+def write_sync_bundle_job(db_path, file_path, peer):
+    """Job nel pool di worker: scrive il pacchetto di modifiche per peer (None = esportazione completa).
+
+    Parte sempre dall'ultimo seq confermato dalla sede: ultimo_seq_inviato avanza solo quando un suo
+    pacchetto ne riporta la ricezione, quindi un pacchetto perso viene semplicemente rigenerato.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        settings = dict(conn.execute("SELECT chiave, valore FROM impostazioni WHERE chiave IN ('istanza_id', 'nome_sede')"))
+        to_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM registro_modifiche').fetchone()[0]
+        since_seq = None
+        if peer is not None:
+            since_seq = conn.execute('SELECT ultimo_seq_inviato FROM sync_peer WHERE istanza = ?', (peer,)).fetchone()[0]
+        changes = collect_sync_changes(conn, since_seq, to_seq, peer or '')
+
+        shipped = {}
+        for change in changes:
+            if change['tabella'] != 'allegati' or change['op'] != 'U':
+                continue
+            content_hash = change['dati']['hash_contenuto']
+            if content_hash in shipped:
+                continue
+            if peer is not None and conn.execute(
+                    'SELECT 1 FROM sync_hash_peer WHERE istanza = ? AND hash = ?', (peer, content_hash)).fetchone():
+                continue
+            shipped[content_hash] = change['dati']['tipo_file']
+
+        try:
+            with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+                bundle.writestr('manifest.json', json.dumps({
+                    'formato': SYNC_BUNDLE_VERSION,
+                    'origine': settings['istanza_id'],
+                    'nome_origine': settings['nome_sede'],
+                    'da_seq': since_seq,
+                    'a_seq': to_seq,
+                    'modifiche': len(changes),
+                    # Conferme di ricezione: fin dove sono arrivati i pacchetti di ogni sede
+                    'conferme': dict(conn.execute('SELECT istanza, ultimo_seq_ricevuto FROM sync_peer')),
+                    'creato_il': datetime.now().isoformat(timespec='seconds')
+                }, indent=2))
+                bundle.writestr('modifiche.jsonl', ''.join(json.dumps(change, ensure_ascii=False) + '\n' for change in changes))
+
+                for content_hash, tipo_file in shipped.items():
+                    allegato_id = conn.execute('SELECT id FROM allegati WHERE hash_contenuto = ? LIMIT 1',
+                                               (content_hash,)).fetchone()[0]
+                    info = zipfile.ZipInfo(f'blob/{content_hash}', date_time=datetime.now().timetuple()[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED if tipo_file == 'txt' else zipfile.ZIP_STORED
+                    with bundle.open(info, 'w', force_zip64=True) as member:
+                        for chunk in iter_blob_chunks(conn, allegato_id):
+                            member.write(chunk)
+        except BaseException:
+            # Un pacchetto incompleto non va lasciato dove potrebbe essere importato
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        return {'modifiche': len(changes), 'allegati': len(shipped)}
+    finally:
+        conn.close()
+
+
+def load_thumbnail(db_path, allegato_id, max_side):
+    """Eseguita nel pool di worker: legge l'immagine con una connessione propria e la ridimensiona"""
+    conn = sqlite3.connect(db_path)
+    try:
+        data = b''.join(iter_blob_chunks(conn, allegato_id))
+    finally:
+        conn.close()
+    return make_thumbnail(data, max_side)
+
+
+def make_thumbnail(data, max_side):
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side))
+    return image
+
+
+PREVIEW_THUMBNAIL_SIZE = 250
+ATTACHMENT_SIZE_LIMITS = {'image': 50 * 1024 * 1024, 'txt': 10 * 1024 * 1024, 'docx': 25 * 1024 * 1024}
+ATTACHMENT_EXTENSIONS = {'.png': 'image', '.jpg': 'image', '.jpeg': 'image', '.gif': 'image', '.bmp': 'image',
+                         '.webp': 'image', '.txt': 'txt', '.log': 'txt', '.csv': 'txt', '.docx': 'docx'}
+IMAGE_SIGNATURES = (b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'BM')
+
+
+def sniff_attachment_type(path, head):
+    """Tipo di allegato dai primi byte del file (l'estensione serve solo a distinguere i DOCX dagli altri zip)"""
+    if head.startswith(IMAGE_SIGNATURES) or (head.startswith(b'RIFF') and head[8:12] == b'WEBP'):
+        return 'image'
+    if head.startswith(b'PK\x03\x04'):
+        return 'docx' if path.lower().endswith('.docx') else None
+    if b'\x00' not in head:
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(head)
+            return 'txt'
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+def prepare_image_attachment(name, source, policy):
+    """Eseguita nel pool di worker: immagine normalizzata con hash e miniatura per l'anteprima"""
+    data, image_format, original_size, hashes = prepare_image(source, policy)
+    extension = IMAGE_EXTENSIONS.get(image_format)
+    if extension and os.path.splitext(name)[1].lower() != extension:
+        name = os.path.splitext(name)[0] + extension
+    return {'name': name, 'type': 'image', 'data': data, 'original_size': original_size, 'hashes': hashes,
+            'thumbnail': make_thumbnail(data, PREVIEW_THUMBNAIL_SIZE)}
+
+
+def load_attachment_file(path, policy):
+    """Eseguita nel pool di worker: controlla tipo e dimensione prima di leggere il file in memoria"""
+    size = os.stat(path).st_size
+    with open(path, 'rb') as f:
+        head = f.read(512)
+        file_type = sniff_attachment_type(path, head)
+        if file_type is None:
+            raise ValueError("tipo di file non supportato")
+        if size > ATTACHMENT_SIZE_LIMITS[file_type]:
+            raise ValueError(f"file troppo grande ({format_size(size)}, limite {format_size(ATTACHMENT_SIZE_LIMITS[file_type])})")
+        data = head + f.read()
+
+    name = os.path.basename(path)
+    if file_type == 'image':
+        attachment = prepare_image_attachment(name, data, policy)
+    else:
+        attachment = {'name': name, 'type': file_type, 'data': data}
+    attachment['content_hash'] = hashlib.sha256(data).hexdigest()
+    return attachment
+
+
+class AttachmentGallery:
+    """Galleria a griglia virtualizzata: crea riquadri e PhotoImage solo vicino all'area visibile.
+
+    Le miniature vengono decodificate nel pool di worker (con qualche riga di anticipo sullo scorrimento)
+    e tenute in una cache LRU dimensionata sull'area visibile: non vengono mai scartate quelle dei riquadri
+    presenti sul canvas. Alla chiusura della finestra tutto viene rilasciato.
+    """
+
+    def __init__(self, app, parent, images):
+        self.app = app
+        self.images = images
+        self.photos = OrderedDict()
+        self.pending = {}
+        self.tiles = {}
+        self.selected = None
+        self.columns = 1
+        self.cache_size = GALLERY_CACHE_SIZE
+        self.closed = False
+        self.update_scheduled = False
+        self.cell_width = GALLERY_TILE_SIZE + 2 * GALLERY_TILE_PADDING
+        self.cell_height = GALLERY_TILE_SIZE + GALLERY_CAPTION_HEIGHT + 2 * GALLERY_TILE_PADDING
+
+        frame = ttk.Frame(parent)
+        frame.pack(fill='both', expand=True)
+        self.canvas = tk.Canvas(frame, background='white', highlightthickness=0,
+                                yscrollincrement=self.cell_height // 4)
+        self.scrollbar = ttk.Scrollbar(frame, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self._on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+
+        btn_frame = ttk.Frame(parent)
+        btn_frame.pack(pady=5)
+        self.save_button = ttk.Button(btn_frame, text="💾 Salva Immagine", state='disabled',
+                                      command=lambda: self.app.save_attachment_to_file(*self.images[self.selected]))
+        self.save_button.pack(side=tk.LEFT, padx=5)
+        self.similar_button = ttk.Button(btn_frame, text="🔍 Interventi con Immagini Simili", state='disabled',
+                                         command=lambda: self.app.search_similar_to_attachment(self.images[self.selected][0]))
+        self.similar_button.pack(side=tk.LEFT, padx=5)
+        ttk.Label(btn_frame, text="Doppio clic per ingrandire", foreground='gray').pack(side=tk.LEFT, padx=5)
+
+        self.canvas.bind('<Configure>', self._on_resize)
+        self.canvas.bind('<Button-1>', self._on_click)
+        self.canvas.bind('<Double-1>', self._on_double_click)
+        self.canvas.bind('<MouseWheel>', lambda e: self.canvas.yview_scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.canvas.bind('<Button-4>', lambda e: self.canvas.yview_scroll(-1, 'units'))
+        self.canvas.bind('<Button-5>', lambda e: self.canvas.yview_scroll(1, 'units'))
+        self.canvas.bind('<Destroy>', lambda e: self.close())
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.schedule_update()
+
+    def _on_resize(self, event):
+        columns = max(1, event.width // self.cell_width)
+        if columns != self.columns:
+            self.columns = columns
+            for index in list(self.tiles):
+                self._drop_tile(index)
+        rows = -(-len(self.images) // self.columns)
+        self.canvas.configure(scrollregion=(0, 0, self.columns * self.cell_width, rows * self.cell_height))
+        self.schedule_update()
+
+    def schedule_update(self):
+        if not self.update_scheduled and not self.closed:
+            self.update_scheduled = True
+            self.canvas.after_idle(self._update_viewport)
+
+    def _index_at(self, event):
+        column = int(self.canvas.canvasx(event.x) // self.cell_width)
+        index = int(self.canvas.canvasy(event.y) // self.cell_height) * self.columns + column
+        return index if column < self.columns and 0 <= index < len(self.images) else None
+
+    def _update_viewport(self):
+        self.update_scheduled = False
+        if self.closed:
+            return
+
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first = int(top // self.cell_height) * self.columns
+        last = min(len(self.images), (int(bottom // self.cell_height) + 1) * self.columns)
+        near_first = max(0, first - self.columns)
+        near_last = min(len(self.images), last + GALLERY_PREFETCH_ROWS * self.columns)
+        # Su una finestra grande i riquadri vicini possono superare GALLERY_CACHE_SIZE
+        self.cache_size = max(GALLERY_CACHE_SIZE, near_last - near_first)
+
+        for index in [i for i in self.tiles if not near_first <= i < near_last]:
+            self._drop_tile(index)
+        for index in [i for i in self.pending if not near_first <= i < near_last]:
+            if self.pending[index].cancel():
+                del self.pending[index]
+
+        # Prima i riquadri visibili, poi quelli da precaricare
+        for index in itertools.chain(range(first, last), range(last, near_last), range(near_first, first)):
+            allegato_id = self.images[index][0]
+            if index not in self.tiles:
+                self._create_tile(index)
+            if allegato_id in self.photos:
+                self.photos.move_to_end(allegato_id)
+                self.canvas.itemconfig(self.tiles[index]['image'], image=self.photos[allegato_id])
+            elif index not in self.pending:
+                self.pending[index] = self.app.run_in_background(
+                    load_thumbnail, self.app.db_path, allegato_id, GALLERY_TILE_SIZE,
+                    on_done=lambda image, i=index: self._on_thumbnail(i, image),
+                    on_error=lambda error, i=index: self._on_thumbnail_failed(i, error))
+
+    def _create_tile(self, index):
+        row, column = divmod(index, self.columns)
+        x0 = column * self.cell_width + GALLERY_TILE_PADDING
+        y0 = row * self.cell_height + GALLERY_TILE_PADDING
+        center = x0 + GALLERY_TILE_SIZE / 2
+        selected = index == self.selected
+        self.tiles[index] = {
+            'frame': self.canvas.create_rectangle(x0, y0, x0 + GALLERY_TILE_SIZE, y0 + GALLERY_TILE_SIZE,
+                                                  fill='#f4f4f4', outline='#1f6fd1' if selected else '#cccccc',
+                                                  width=3 if selected else 1),
+            'image': self.canvas.create_image(center, y0 + GALLERY_TILE_SIZE / 2, anchor='center'),
+            'caption': self.canvas.create_text(center, y0 + GALLERY_TILE_SIZE + GALLERY_CAPTION_HEIGHT / 2,
+                                               text=self.images[index][1], width=GALLERY_TILE_SIZE),
+        }
+
+    def _drop_tile(self, index):
+        self.canvas.delete(*self.tiles.pop(index).values())
+
+    def _on_thumbnail(self, index, image):
+        self.pending.pop(index, None)
+        if self.closed:
+            return
+
+        allegato_id = self.images[index][0]
+        self.photos[allegato_id] = ImageTk.PhotoImage(image)
+        self._evict()
+        if index in self.tiles:
+            self.canvas.itemconfig(self.tiles[index]['image'], image=self.photos[allegato_id])
+
+    def _evict(self):
+        """Scarta le miniature meno recenti oltre la capienza, saltando quelle dei riquadri sul canvas"""
+        excess = len(self.photos) - self.cache_size
+        if excess <= 0:
+            return
+        in_use = {self.images[index][0] for index in self.tiles}
+        for allegato_id in [a for a in self.photos if a not in in_use][:excess]:
+            del self.photos[allegato_id]
+
+    def _on_thumbnail_failed(self, index, error):
+        self.pending.pop(index, None)
+        if not self.closed and index in self.tiles:
+            self.canvas.itemconfig(self.tiles[index]['caption'], text=f"Errore: {error}", fill='red')
+
+    def _on_click(self, event):
+        index = self._index_at(event)
+        if index is None:
+            return
+        if self.selected in self.tiles:
+            self.canvas.itemconfig(self.tiles[self.selected]['frame'], outline='#cccccc', width=1)
+        self.selected = index
+        self.canvas.itemconfig(self.tiles[index]['frame'], outline='#1f6fd1', width=3)
+        self.save_button.config(state='normal')
+        self.similar_button.config(state='normal')
+
+    def _on_double_click(self, event):
+        index = self._index_at(event)
+        if index is None:
+            return
+
+        allegato_id, nome = self.images[index]
+        viewer = tk.Toplevel(self.canvas)
+        viewer.title(nome)
+        label = ttk.Label(viewer, text="Caricamento...", padding="10")
+        label.pack()
+
+        def show(image):
+            if label.winfo_exists():
+                viewer.photo = ImageTk.PhotoImage(image)
+                label.config(image=viewer.photo, text='')
+
+        def failed(error):
+            if label.winfo_exists():
+                label.config(text=f"Errore: {error}")
+
+        self.app.run_in_background(load_thumbnail, self.app.db_path, allegato_id, GALLERY_VIEWER_SIZE,
+                                   on_done=show, on_error=failed)
+
+    def close(self):
+        self.closed = True
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.photos.clear()
+        self.tiles.clear()
+
+
+LAG_HEARTBEAT_MS = 100
+LAG_THRESHOLD_MS = 250
+LAG_SAMPLE_INTERVAL_S = 0.005
+LAG_LOG_FILE = 'ui_lag.log'
+LAG_LOG_MAX_BYTES = 1024 * 1024
+LAG_LOG_BACKUPS = 3
+LAG_TOP_STACKS = 5
+
+
+class LagWatchdog:
+    """Misura il ritardo del ciclo eventi di Tk e campiona lo stack del thread bloccato.
+
+    Un battito con after() aggiorna l'ora dell'ultimo giro del ciclo eventi; un thread separato, quando il
+    battito tarda oltre la soglia, campiona lo stack del thread di Tk con sys._current_frames(). A fine blocco
+    gli stack piu' frequenti e il riepilogo cumulativo delle funzioni piu' lente vanno in un log a rotazione.
+    """
+
+    def __init__(self, root, log_path=LAG_LOG_FILE, threshold_ms=LAG_THRESHOLD_MS):
+        self.root = root
+        self.threshold = threshold_ms / 1000
+        self.interval = LAG_HEARTBEAT_MS / 1000
+        self.tk_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.hot_spots = {}
+        self.episodes = 0
+        self.running = True
+
+        self.logger = logging.getLogger('ver.lag')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        # Il logger e' condiviso nel processo: il file aperto da un'istanza precedente puo' essere un altro
+        self.log_path = os.path.abspath(log_path)
+        for handler in list(self.logger.handlers):
+            if getattr(handler, 'baseFilename', None) != self.log_path:
+                self.logger.removeHandler(handler)
+                handler.close()
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=LAG_LOG_MAX_BYTES,
+                                                           backupCount=LAG_LOG_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(handler)
+
+        self.root.after(LAG_HEARTBEAT_MS, self._beat)
+        self.thread = threading.Thread(target=self._monitor, name='lag-watchdog', daemon=True)
+        self.thread.start()
+
+    def _beat(self):
+        now = time.monotonic()
+        self.max_lag = max(self.max_lag, now - self.last_beat - self.interval)
+        self.last_beat = now
+        if self.running:
+            self.root.after(LAG_HEARTBEAT_MS, self._beat)
+
+    def _stack_key(self, frame):
+        """Frame di questo modulo piu' il frame piu' interno (spesso una libreria), dal piu' esterno"""
+        stack = traceback.extract_stack(frame)
+        frames = [f for f in stack[:-1] if f.filename == __file__] + [stack[-1]]
+        return tuple(f"{os.path.basename(f.filename)}:{f.name}:{f.lineno}" for f in frames)
+
+    def _monitor(self):
+        samples = {}
+        started = None
+        while self.running:
+            now = time.monotonic()
+            stalled = now - self.last_beat - self.interval
+            if stalled >= self.threshold:
+                if started is None:
+                    started = self.last_beat
+                    samples = {}
+                    last_sample = now
+                # Ogni campione pesa il tempo reale trascorso dal precedente (lo sleep si allunga col GIL conteso)
+                frame = sys._current_frames().get(self.tk_thread_id)
+                if frame is not None:
+                    key = self._stack_key(frame)
+                    samples[key] = samples.get(key, 0) + (now - last_sample)
+                del frame
+                last_sample = now
+                time.sleep(LAG_SAMPLE_INTERVAL_S)
+            else:
+                if started is not None:
+                    self._record_episode(self.last_beat - started - self.interval, samples)
+                    started = None
+                time.sleep(self.interval / 2)
+
+    def _record_episode(self, duration, samples):
+        self.episodes += 1
+        total = sum(samples.values()) or 1
+        lines = [f"Blocco UI di {duration * 1000:.0f} ms ({total * 1000:.0f} ms campionati)"]
+        for key, seconds in sorted(samples.items(), key=lambda item: -item[1])[:LAG_TOP_STACKS]:
+            lines.append(f"  {seconds * 100 / total:3.0f}%  {' > '.join(key)}")
+
+        # Tempo inclusivo per funzione: ogni funzione conta una volta per campione
+        for key, seconds in samples.items():
+            for function in {entry.rsplit(':', 1)[0] for entry in key}:
+                self.hot_spots[function] = self.hot_spots.get(function, 0) + seconds
+        lines.append("  Cumulativo (s): " + ', '.join(f"{name} {seconds:.2f}" for name, seconds in self.hot_spot_summary(8)))
+        self.logger.info('\n'.join(lines))
+
+    def hot_spot_summary(self, limit=20):
+        return sorted(self.hot_spots.items(), key=lambda item: -item[1])[:limit]
+
+    def stop(self):
+        self.running = False
+
+
+ARCHIVE_WORKERS = min(4, os.cpu_count() or 1)
+ARCHIVE_MAX_IN_FLIGHT = 2 * ARCHIVE_WORKERS
+ARCHIVE_SPOOL_MEMORY = 1024 * 1024
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_RESUME_SUFFIX = '.ripresa'
+ARCHIVE_ENTRIES_SUFFIX = '.ripresa.voci'
+ARCHIVE_CSV_FIELDS = ('id', 'uuid', 'data_ora', 'macchina', 'operatore', 'categoria', 'problema', 'soluzione')
+
+
+def spool_attachment(db_path, allegato_id):
+    """Eseguita nei worker dell'export: decodifica l'allegato a blocchi e lo comprime (deflate grezzo) se conviene.
+
+    Il risultato finisce in un file temporaneo che resta in memoria solo sotto ARCHIVE_SPOOL_MEMORY.
+    Restituisce (file, compress_type, crc, dimensione originale, dimensione nel file).
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_MEMORY)
+    compress_type, compressor = zipfile.ZIP_STORED, None
+    crc = size = 0
+    conn = sqlite3.connect(db_path)
+    try:
+        for chunk in iter_blob_chunks(conn, allegato_id):
+            if size == 0 and not is_already_compressed(chunk):
+                compress_type = zipfile.ZIP_DEFLATED
+                compressor = zlib.compressobj(ARCHIVE_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            spool.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            spool.write(compressor.flush())
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        conn.close()
+    stored_size = spool.tell()
+    spool.seek(0)
+    return spool, compress_type, crc, size, stored_size
+
+
+def write_spooled_entry(zf, name, date_time, spooled):
+    """Copia nello zip un allegato preparato da spool_attachment, senza ricomprimerlo"""
+    spool, compress_type, crc, size, stored_size = spooled
+    zip64 = max(size, stored_size) > zipfile.ZIP64_LIMIT
+    zinfo = zipfile.ZipInfo(name, date_time)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = stored_size
+    with spool, zf.open(zinfo, 'w', force_zip64=zip64) as entry:
+        shutil.copyfileobj(spool, entry, CHUNK_SIZE)
+
+    if compress_type == zipfile.ZIP_DEFLATED:
+        # I byte scritti sono gia' il flusso deflate: si correggono metodo, CRC e dimensione nell'intestazione
+        # locale; la directory centrale viene scritta alla chiusura dallo stesso ZipInfo
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        end = zf.fp.tell()
+        zf.fp.seek(zinfo.header_offset)
+        zf.fp.write(zinfo.FileHeader(zip64))
+        zf.fp.seek(end)
+
+
+def archive_entry_name(intervento_id, allegato_id, nome_file):
+    safe_name = re.sub(r'[\\/:*?"<>|]+', '_', nome_file).strip() or 'allegato'
+    return f"allegati/{intervento_id}/{allegato_id}_{safe_name}"
+
+
+def archive_date_time(data_ora):
+    try:
+        moment = datetime.strptime(data_ora[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return (1980, 1, 1, 0, 0, 0)
+    return max(moment.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def _archive_checkpoint(zf, zip_path, state):
+    """Salva accanto allo zip l'ultimo intervento esportato e le sole voci aggiunte dall'ultimo checkpoint.
+
+    Le voci finiscono in un file JSONL in sola aggiunta, cosi' il costo di un checkpoint dipende dal blocco
+    e non dalla dimensione dell'archivio; lo stato ricorda fin dove quel file e' valido.
+    """
+    zf.fp.flush()
+    state['data_end'] = zf.fp.tell()
+    entries = zf.infolist()[state['voci']:]
+    with open(zip_path + ARCHIVE_ENTRIES_SUFFIX, 'a', encoding='utf-8') as f:
+        f.seek(state['voci_bytes'])
+        f.truncate()
+        for info in entries:
+            f.write(json.dumps({'nome': info.filename, 'data': info.date_time, 'metodo': info.compress_type,
+                                'crc': info.CRC, 'compressa': info.compress_size, 'dimensione': info.file_size,
+                                'offset': info.header_offset, 'flag': info.flag_bits,
+                                'attributi': info.external_attr}) + '\n')
+        state['voci_bytes'] = f.tell()
+    state['voci'] += len(entries)
+    temp_path = zip_path + ARCHIVE_RESUME_SUFFIX + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temp_path, zip_path + ARCHIVE_RESUME_SUFFIX)
+
+
+def _reopen_archive(fp, zip_path, state):
+    """Riporta lo zip all'ultimo checkpoint e ricostruisce l'elenco delle voci gia' scritte"""
+    fp.truncate(state['data_end'])
+    fp.seek(state['data_end'])
+    zf = zipfile.ZipFile(fp, 'w', compression=zipfile.ZIP_DEFLATED)
+    with open(zip_path + ARCHIVE_ENTRIES_SUFFIX, 'rb') as f:
+        lines = f.read(state['voci_bytes']).decode('utf-8').splitlines()
+    for line in lines:
+        entry = json.loads(line)
+        info = zipfile.ZipInfo(entry['nome'], tuple(entry['data']))
+        info.compress_type = entry['metodo']
+        info.CRC = entry['crc']
+        info.compress_size = entry['compressa']
+        info.file_size = entry['dimensione']
+        info.header_offset = entry['offset']
+        info.flag_bits = entry['flag']
+        info.external_attr = entry['attributi']
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+    return zf
+
+
+def read_archive_resume(zip_path, db_path):
+    """Stato di un export interrotto verso zip_path, se esiste ed e' relativo allo stesso database"""
+    try:
+        with open(zip_path + ARCHIVE_RESUME_SUFFIX, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (state.get('db') != os.path.abspath(db_path) or not os.path.exists(zip_path)
+            or not os.path.exists(zip_path + ARCHIVE_ENTRIES_SUFFIX)):
+        return None
+    return state
+
+
+def discard_archive(zip_path):
+    """Elimina un export interrotto che non verra' ripreso: zip parziale e file di ripresa"""
+    for path in (zip_path, zip_path + ARCHIVE_RESUME_SUFFIX, zip_path + ARCHIVE_ENTRIES_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def export_archive(db_path, zip_path, where='1', params=(), state=None, progress=None, cancel=None):
+    """Esporta interventi e allegati in uno zip a memoria costante, riprendibile dall'ultimo checkpoint.
+
+    Gli allegati sono letti e compressi da ARCHIVE_WORKERS thread con al piu' ARCHIVE_MAX_IN_FLIGHT in coda;
+    lo zip viene scritto in ordine di id e chiuso dopo ogni blocco di ARCHIVE_BATCH_SIZE interventi.
+    """
+    if state is None:
+        state = {'db': os.path.abspath(db_path), 'where': where, 'params': list(params),
+                 'last_id': 0, 'parte': 0, 'interventi': 0, 'allegati': 0, 'voci': 0, 'voci_bytes': 0}
+        fp = open(zip_path, 'w+b')
+        zf = zipfile.ZipFile(fp, 'w', compression=zipfile.ZIP_DEFLATED)
+    else:
+        # I dati scritti dopo l'ultimo checkpoint (e la directory centrale di una chiusura) vengono scartati
+        fp = open(zip_path, 'r+b')
+        zf = _reopen_archive(fp, zip_path, state)
+    where, params = state['where'], state['params']
+
+    conn = sqlite3.connect(db_path)
+    pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS)
+    pending = deque()
+    try:
+        total = conn.execute(f'SELECT COUNT(*) FROM interventi WHERE {where}', params).fetchone()[0]
+        while True:
+            if progress:
+                progress(state['interventi'], total)
+            if cancel is not None and cancel.is_set():
+                # Lo stato e' gia' salvato all'ultimo blocco; la chiusura lascia uno zip parziale leggibile
+                zf.close()
+                state['completato'] = False
+                return state
+
+            batch = conn.execute(f'''
+                SELECT {', '.join(ARCHIVE_CSV_FIELDS)} FROM interventi
+                WHERE id > ? AND ({where}) ORDER BY id LIMIT ?
+            ''', [state['last_id']] + list(params) + [ARCHIVE_BATCH_SIZE]).fetchall()
+            if not batch:
+                break
+
+            dates = {row[0]: archive_date_time(row[2]) for row in batch}
+            placeholders = ', '.join('?' * len(batch))
+            attachments = conn.execute(f'''
+                SELECT id, intervento_id, nome_file, tipo_file FROM allegati
+                WHERE intervento_id IN ({placeholders}) ORDER BY intervento_id, id
+            ''', list(dates)).fetchall()
+
+            files = {}
+            for allegato_id, intervento_id, nome_file, tipo_file in attachments:
+                name = archive_entry_name(intervento_id, allegato_id, nome_file)
+                files.setdefault(intervento_id, []).append({'file': name, 'tipo': tipo_file})
+                pending.append((name, dates[intervento_id], pool.submit(spool_attachment, db_path, allegato_id)))
+                if len(pending) >= ARCHIVE_MAX_IN_FLIGHT:
+                    name, date_time, future = pending.popleft()
+                    write_spooled_entry(zf, name, date_time, future.result())
+            while pending:
+                name, date_time, future = pending.popleft()
+                write_spooled_entry(zf, name, date_time, future.result())
+
+            state['parte'] += 1
+            manifest = ''.join(json.dumps(dict(zip(ARCHIVE_CSV_FIELDS, row), allegati=files.get(row[0], [])),
+                                          ensure_ascii=False) + '\n' for row in batch)
+            zf.writestr(f"manifest/parte_{state['parte']:05d}.jsonl", manifest)
+
+            state['last_id'] = batch[-1][0]
+            state['interventi'] += len(batch)
+            state['allegati'] += len(attachments)
+            _archive_checkpoint(zf, zip_path, state)
+
+        # Riepilogo CSV di tutti gli interventi esportati, scritto in streaming
+        with zf.open('interventi.csv', 'w', force_zip64=True) as entry:
+            text = io.TextIOWrapper(entry, encoding='utf-8-sig', newline='')
+            writer = csv.writer(text)
+            writer.writerow(ARCHIVE_CSV_FIELDS + ('allegati',))
+            last_id = 0
+            while True:
+                rows = conn.execute(f'''
+                    SELECT {', '.join(ARCHIVE_CSV_FIELDS)},
+                           (SELECT COUNT(*) FROM allegati a WHERE a.intervento_id = interventi.id)
+                    FROM interventi WHERE id > ? AND id <= ? AND ({where})
+                    ORDER BY id LIMIT ?
+                ''', [last_id, state['last_id']] + list(params) + [ARCHIVE_BATCH_SIZE]).fetchall()
+                if not rows:
+                    break
+                writer.writerows(rows)
+                last_id = rows[-1][0]
+            text.flush()
+            text.detach()
+        zf.close()
+        fp.close()
+        for suffix in (ARCHIVE_RESUME_SUFFIX, ARCHIVE_ENTRIES_SUFFIX):
+            if os.path.exists(zip_path + suffix):
+                os.remove(zip_path + suffix)
+        state['completato'] = True
+        return state
+    except BaseException:
+        # Un errore in chiusura (es. voce ancora aperta) non deve nascondere quello originale
+        try:
+            zf.close()
+        except Exception:
+            pass
+        raise
+    finally:
+        for _, _, future in pending:
+            if not future.cancel() and future.exception() is None:
+                future.result()[0].close()
+        pool.shutdown(wait=True)
+        conn.close()
+        fp.close()
+
 
 class MachineTrackerApp:
     def __init__(self, root):
@@ -18,14 +1969,50 @@ class MachineTrackerApp:
         self.root.title("Sistema Tracciamento Modifiche Macchine")
         self.root.geometry("1400x800")
         self.current_attachments = []
-        self.preview_widgets = []
+        self.preview_widgets = {}
+        self.attachment_ids = itertools.count(1)
+        self.pending_ingest = 0
+        self.ingest_totals = {'count': 0, 'before': 0, 'after': 0}
+        self.worker_count = min(4, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        # File in attesa di elaborazione: al pool ne arrivano al piu' 2 per worker alla volta
+        self.ingest_queue = deque()
+        self.ingest_in_flight = 0
+        self.last_activity = time.monotonic()
+        self.records = RecordCache()
+        self.analytics = ReliabilityAnalytics(self.records)
+        self.minhash_index = None
+        self.minhash_pending = None
+        self.image_index = None
+        self.facets = FacetIndex(self.records)
+        self.lag_watchdog = None
         self.init_database()
+        self.records.refresh(self.conn)
         self.create_widgets()        
         self.load_all_records()
+        self.start_minhash_index()
+        self.start_idle_maintenance()
+        self.backup_running = False
+        self.root.after(BACKUP_CHECK_INTERVAL_MS, self._scheduled_backup_check)
+        # Al primo giro del ciclo eventi: la costruzione iniziale non va registrata come blocco dell'interfaccia
+        self.root.after_idle(self.start_lag_watchdog)
+
+    def start_lag_watchdog(self):
+        log_path = os.path.join(os.path.dirname(os.path.abspath(self.db_path)), LAG_LOG_FILE)
+        self.lag_watchdog = LagWatchdog(self.root, log_path)
     
     def init_database(self):
-        self.conn = sqlite3.connect('macchine_tracker.db')
+        self.db_path = 'macchine_tracker.db'
+        self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
+
+        # auto_vacuum va impostato prima di creare le tabelle; sui database esistenti serve un VACUUM
+        self.cursor.execute('PRAGMA auto_vacuum')
+        if self.cursor.fetchone()[0] != 2:
+            self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.cursor.execute('SELECT COUNT(*) FROM sqlite_master')
+            if self.cursor.fetchone()[0]:
+                self.cursor.execute('VACUUM')
         
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS interventi (
@@ -49,23 +2036,830 @@ class MachineTrackerApp:
                 FOREIGN KEY (intervento_id) REFERENCES interventi(id) ON DELETE CASCADE
             )
         ''')
-        
-        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='immagini'")
-        if self.cursor.fetchone():
+        
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='immagini'")
+        if self.cursor.fetchone():
+            try:
+                self.cursor.execute('''
+                    INSERT INTO allegati (intervento_id, nome_file, tipo_file, contenuto)
+                    SELECT intervento_id, nome_file, 'image', immagine FROM immagini
+                ''')
+                self.cursor.execute('DROP TABLE immagini')
+                self.conn.commit()
+            except:
+                pass
+
+        self.add_column_if_missing('allegati', 'codec', f"TEXT NOT NULL DEFAULT '{CODEC_RAW}'")
+        self.add_column_if_missing('allegati', 'dhash', 'INTEGER')
+        self.add_column_if_missing('allegati', 'phash', 'INTEGER')
+
+        # Indici composti per i filtri della ricerca: uguaglianza sul filtro, poi ordinamento per data
+        for column in FACET_COLUMNS:
+            self.cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_interventi_{column}_data ON interventi({column}, data_ora)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_interventi_data ON interventi(data_ora)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_allegati_intervento_tipo ON allegati(intervento_id, tipo_file)')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS impostazioni (
+                chiave TEXT PRIMARY KEY,
+                valore TEXT NOT NULL
+            )
+        ''')
+
+        self.init_sync_schema()
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS minhash_firme (
+                intervento_id INTEGER PRIMARY KEY,
+                firma BLOB NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_interventi_minhash_delete AFTER DELETE ON interventi
+            BEGIN
+                DELETE FROM minhash_firme WHERE intervento_id = OLD.id;
+            END
+        ''')
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cluster_guasti (
+                id INTEGER PRIMARY KEY,
+                etichetta TEXT NOT NULL,
+                dimensione INTEGER NOT NULL,
+                creato_il TEXT NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS interventi_cluster (
+                intervento_id INTEGER PRIMARY KEY,
+                cluster_id INTEGER NOT NULL,
+                similarita REAL NOT NULL
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_interventi_cluster_cluster ON interventi_cluster(cluster_id)')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_interventi_cluster_delete AFTER DELETE ON interventi
+            BEGIN
+                DELETE FROM interventi_cluster WHERE intervento_id = OLD.id;
+            END
+        ''')
+
+        self.conn.commit()
+
+    def init_sync_schema(self):
+        """ID globali, hash dei contenuti e registro modifiche per la sincronizzazione tra sedi"""
+        self.add_column_if_missing('interventi', 'uuid', 'TEXT')
+        self.add_column_if_missing('allegati', 'uuid', 'TEXT')
+        self.add_column_if_missing('allegati', 'hash_contenuto', 'TEXT')
+
+        self.cursor.execute(f'UPDATE interventi SET uuid = {NEW_UUID_SQL} WHERE uuid IS NULL')
+        self.cursor.execute(f'UPDATE allegati SET uuid = {NEW_UUID_SQL} WHERE uuid IS NULL')
+        self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_interventi_uuid ON interventi(uuid)')
+        self.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_allegati_uuid ON allegati(uuid)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_allegati_hash ON allegati(hash_contenuto)')
+
+        missing_hashes = self.conn.execute('SELECT id FROM allegati WHERE hash_contenuto IS NULL').fetchall()
+        for (allegato_id,) in missing_hashes:
+            digest = hashlib.sha256()
+            for chunk in self.iter_attachment_chunks(allegato_id):
+                digest.update(chunk)
+            self.cursor.execute('UPDATE allegati SET hash_contenuto = ? WHERE id = ?', (digest.hexdigest(), allegato_id))
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS registro_modifiche (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tabella TEXT NOT NULL,
+                uuid TEXT NOT NULL,
+                operazione TEXT NOT NULL,
+                origine TEXT NOT NULL DEFAULT ''
+            )
+        ''')
+
+        # Le righe precedenti al registro non hanno mai generato una voce: senza questa
+        # inizializzazione la prima esportazione incrementale ne tralascerebbe lo storico
+        if self.get_setting('registro_inizializzato') is None:
+            for table in ('interventi', 'allegati'):
+                self.cursor.execute(f'''
+                    INSERT INTO registro_modifiche (tabella, uuid, operazione)
+                    SELECT '{table}', uuid, 'I' FROM {table}
+                    WHERE uuid NOT IN (SELECT uuid FROM registro_modifiche WHERE tabella = '{table}')
+                    ORDER BY id
+                ''')
+            self.cursor.execute("INSERT INTO impostazioni (chiave, valore) VALUES ('registro_inizializzato', '1')")
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_peer (
+                istanza TEXT PRIMARY KEY,
+                nome TEXT NOT NULL,
+                ultimo_seq_inviato INTEGER NOT NULL DEFAULT 0,
+                ultimo_seq_ricevuto INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Hash dei contenuti che una sede possiede gia': non serve rispedirli
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_hash_peer (
+                istanza TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (istanza, hash)
+            ) WITHOUT ROWID
+        ''')
+        # Peer provvisori delle esportazioni complete: sostituiti dalle conferme di ricezione
+        self.cursor.execute("DELETE FROM sync_hash_peer WHERE istanza LIKE 'completa:%'")
+        self.cursor.execute("DELETE FROM sync_peer WHERE istanza LIKE 'completa:%'")
+        self.cursor.execute("DELETE FROM impostazioni WHERE chiave LIKE 'seme\\_%' ESCAPE '\\'")
+
+        for table, columns in (('interventi', ', '.join(SYNC_INTERVENTO_FIELDS)),
+                               ('allegati', 'intervento_id, ' + ', '.join(SYNC_ALLEGATO_FIELDS))):
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_insert AFTER INSERT ON {table}
+                BEGIN
+                    UPDATE {table} SET uuid = {NEW_UUID_SQL} WHERE id = NEW.id AND uuid IS NULL;
+                    INSERT INTO registro_modifiche (tabella, uuid, operazione, origine)
+                    VALUES ('{table}', (SELECT uuid FROM {table} WHERE id = NEW.id), 'I', {SYNC_ORIGIN_SQL});
+                END
+            ''')
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_update AFTER UPDATE OF {columns} ON {table}
+                BEGIN
+                    INSERT INTO registro_modifiche (tabella, uuid, operazione, origine)
+                    VALUES ('{table}', NEW.uuid, 'U', {SYNC_ORIGIN_SQL});
+                END
+            ''')
+            self.cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_delete AFTER DELETE ON {table}
+                BEGIN
+                    INSERT INTO registro_modifiche (tabella, uuid, operazione, origine)
+                    VALUES ('{table}', OLD.uuid, 'D', {SYNC_ORIGIN_SQL});
+                END
+            ''')
+
+        if self.get_setting('istanza_id') is None:
+            self.cursor.execute('INSERT INTO impostazioni (chiave, valore) VALUES (?, ?)', ('istanza_id', uuid.uuid4().hex))
+            self.cursor.execute('INSERT OR IGNORE INTO impostazioni (chiave, valore) VALUES (?, ?)', ('nome_sede', socket.gethostname()))
+
+    def get_setting(self, key, default=None):
+        row = self.conn.execute('SELECT valore FROM impostazioni WHERE chiave = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO impostazioni (chiave, valore) VALUES (?, ?)', (key, str(value)))
+        self.conn.commit()
+
+    def get_image_policy(self):
+        return {
+            'max_side': int(self.get_setting('immagini_lato_max', IMAGE_POLICY_DEFAULT['max_side'])),
+            'format': self.get_setting('immagini_formato', IMAGE_POLICY_DEFAULT['format']),
+            'quality': int(self.get_setting('immagini_qualita', IMAGE_POLICY_DEFAULT['quality'])),
+        }
+
+    def start_idle_maintenance(self):
+        for sequence in ('<Any-KeyPress>', '<Any-ButtonPress>', '<MouseWheel>'):
+            self.root.bind_all(sequence, self._mark_activity, add='+')
+        self.root.after(IDLE_MAINTENANCE_INTERVAL_MS, self._idle_maintenance)
+
+    def _mark_activity(self, event=None):
+        self.last_activity = time.monotonic()
+
+    def _idle_maintenance(self):
+        """Restituisce al filesystem poche pagine libere alla volta, solo quando l'utente e' inattivo"""
+        try:
+            if time.monotonic() - self.last_activity >= IDLE_THRESHOLD_S and not self.conn.in_transaction:
+                if self.conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                    # execute() si ferma al primo passo (una pagina), executescript esegue tutto il pragma
+                    self.conn.executescript(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});')
+        except sqlite3.Error:
+            pass
+        finally:
+            self.root.after(IDLE_MAINTENANCE_INTERVAL_MS, self._idle_maintenance)
+
+    def get_page_stats(self):
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return page_size, page_count, freelist_count
+
+    def show_lag_report(self):
+        watchdog = self.lag_watchdog
+        if watchdog is None:
+            messagebox.showinfo("Reattività Interfaccia", "Monitoraggio non ancora avviato.")
+            return
+        report = tk.Toplevel(self.root)
+        report.title("Reattività Interfaccia")
+        report.geometry("700x450")
+
+        text = scrolledtext.ScrolledText(report, wrap=tk.WORD)
+        text.pack(fill='both', expand=True, padx=10, pady=10)
+        text.insert(tk.END, f"Blocchi oltre {watchdog.threshold * 1000:.0f} ms in questa sessione: {watchdog.episodes}\n")
+        text.insert(tk.END, f"Ritardo massimo del ciclo eventi: {watchdog.max_lag * 1000:.0f} ms\n")
+        text.insert(tk.END, f"Log dettagliato: {watchdog.log_path}\n\n")
+        text.insert(tk.END, "Funzioni più lente (tempo cumulativo di blocco):\n")
+        for function, seconds in watchdog.hot_spot_summary():
+            text.insert(tk.END, f"  {seconds:7.2f} s  {function}\n")
+        text.config(state='disabled')
+
+    def compact_database(self):
+        page_size, page_count, freelist_count = self.get_page_stats()
+        free_ratio = freelist_count / page_count if page_count else 0
+
+        if not messagebox.askyesno("Compatta Database",
+                f"Pagine libere: {freelist_count} su {page_count} ({free_ratio:.1%})\n"
+                f"Spazio recuperabile: circa {format_size(freelist_count * page_size)}\n\n"
+                f"Compattare ora il database? L'applicazione resterà bloccata fino al termine."):
+            return
+
+        size_before = os.path.getsize(self.db_path)
+        self.root.config(cursor='watch')
+        self.root.update_idletasks()
+        try:
+            self.conn.commit()
+            self.conn.execute('VACUUM')
+        except sqlite3.Error as e:
+            messagebox.showerror("Errore", f"Errore durante la compattazione: {e}")
+            return
+        finally:
+            self.root.config(cursor='')
+
+        size_after = os.path.getsize(self.db_path)
+        messagebox.showinfo("Compatta Database",
+            f"Compattazione completata!\n\n"
+            f"Prima: {format_size(size_before)} ({free_ratio:.1%} pagine libere)\n"
+            f"Dopo: {format_size(size_after)}\n"
+            f"Spazio recuperato: {format_size(max(0, size_before - size_after))}")
+
+    def get_backup_settings(self):
+        return {
+            'folder': self.get_setting('backup_cartella', BACKUP_DEFAULTS['folder']),
+            'interval_hours': int(self.get_setting('backup_intervallo_ore', BACKUP_DEFAULTS['interval_hours'])),
+            'copies': int(self.get_setting('backup_copie', BACKUP_DEFAULTS['copies'])),
+        }
+
+    def start_backup(self, dest_path, on_done, on_error, progress=None):
+        self.backup_running = True
+
+        def finished(counts):
+            self.backup_running = False
+            on_done(counts)
+
+        def failed(error):
+            self.backup_running = False
+            if os.path.exists(dest_path + '.tmp'):
+                os.remove(dest_path + '.tmp')
+            on_error(error)
+
+        self.conn.commit()
+        self.run_in_background(backup_database, self.db_path, dest_path, progress,
+                               on_done=finished, on_error=failed)
+
+    def backup_now(self):
+        if self.backup_running:
+            messagebox.showinfo("Backup", "Un backup è già in corso.")
+            return
+
+        db_name = os.path.splitext(os.path.basename(self.db_path))[0]
+        dest_path = filedialog.asksaveasfilename(
+            title="Salva Backup",
+            defaultextension=".db",
+            filetypes=[("Database SQLite", "*.db"), ("Tutti i file", "*.*")],
+            initialfile=f"{db_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        )
+        if not dest_path:
+            return
+
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Backup in corso")
+        progress_window.resizable(False, False)
+        frame = ttk.Frame(progress_window, padding="15")
+        frame.pack(fill='both', expand=True)
+        ttk.Label(frame, text="Puoi continuare a lavorare durante il backup.").pack(pady=(0, 10))
+        progress_bar = ttk.Progressbar(frame, length=350, mode='determinate')
+        progress_bar.pack()
+        status_var = tk.StringVar(value="Avvio...")
+        ttk.Label(frame, textvariable=status_var).pack(pady=(10, 0))
+
+        # Aggiornato dal thread di backup, letto dal ciclo eventi di Tk
+        progress_state = {'done': 0, 'total': 0}
+
+        def update_progress(done, total):
+            progress_state['done'], progress_state['total'] = done, total
+
+        def refresh():
+            if not progress_window.winfo_exists() or not self.backup_running:
+                return
+            if progress_state['total']:
+                progress_bar['maximum'] = progress_state['total']
+                progress_bar['value'] = progress_state['done']
+                status_var.set(f"Pagine copiate: {progress_state['done']} / {progress_state['total']}")
+            self.root.after(100, refresh)
+
+        def on_done(counts):
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            messagebox.showinfo("Backup", f"Backup completato e verificato!\n\n"
+                                f"Interventi: {counts['interventi']}\nAllegati: {counts['allegati']}\n\n{dest_path}")
+
+        def on_error(error):
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            messagebox.showerror("Errore Backup", f"Errore durante il backup: {error}")
+
+        self.start_backup(dest_path, on_done, on_error, update_progress)
+        refresh()
+
+    def _scheduled_backup_check(self):
+        try:
+            settings = self.get_backup_settings()
+            last_backup = self.get_setting('backup_ultimo')
+            due = settings['interval_hours'] > 0 and (
+                last_backup is None or
+                (datetime.now() - datetime.fromisoformat(last_backup)).total_seconds() >= settings['interval_hours'] * 3600)
+
+            failures = int(self.get_setting('backup_errori', 0))
+            last_attempt = self.get_setting('backup_ultimo_tentativo')
+            if due and failures and last_attempt:
+                retry_after = min(BACKUP_RETRY_BASE_S * 2 ** (failures - 1), settings['interval_hours'] * 3600)
+                due = (datetime.now() - datetime.fromisoformat(last_attempt)).total_seconds() >= retry_after
+
+            if due and not self.backup_running:
+                self.run_scheduled_backup(settings)
+        finally:
+            self.root.after(BACKUP_CHECK_INTERVAL_MS, self._scheduled_backup_check)
+
+    def run_scheduled_backup(self, settings):
+        folder = settings['folder']
+        if not os.path.isabs(folder):
+            folder = os.path.join(os.path.dirname(os.path.abspath(self.db_path)), folder)
+
+        prefix = os.path.splitext(os.path.basename(self.db_path))[0] + BACKUP_AUTO_SUFFIX
+        dest_path = os.path.join(folder, f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+
+        def on_done(counts):
+            self.set_setting('backup_ultimo', datetime.now().isoformat(timespec='seconds'))
+            self.conn.execute("DELETE FROM impostazioni WHERE chiave IN ('backup_errori', 'backup_ultimo_errore')")
+            self.conn.commit()
+            prune_backups(folder, prefix, settings['copies'])
+
+        def on_error(error):
+            # Nessuna finestra modale: il controllo periodico la riproporrebbe a ogni tentativo
+            failures = int(self.get_setting('backup_errori', 0)) + 1
+            self.set_setting('backup_errori', failures)
+            self.set_setting('backup_ultimo_errore', f"{datetime.now().strftime('%d/%m/%Y %H:%M')} - {error}")
+            logging.getLogger('ver.backup').warning("Backup automatico non riuscito (tentativo %d): %s", failures, error)
+
+        self.set_setting('backup_ultimo_tentativo', datetime.now().isoformat(timespec='seconds'))
+        try:
+            os.makedirs(folder, exist_ok=True)
+        except OSError as e:
+            on_error(e)
+            return
+        self.start_backup(dest_path, on_done, on_error)
+
+    def edit_backup_settings(self):
+        settings = self.get_backup_settings()
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Impostazioni Backup")
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+
+        frame = ttk.Frame(dialog, padding="15")
+        frame.pack(fill='both', expand=True)
+
+        ttk.Label(frame, text="Cartella:").grid(row=0, column=0, sticky=tk.W, pady=5)
+        folder_var = tk.StringVar(value=settings['folder'])
+        ttk.Entry(frame, textvariable=folder_var, width=40).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
+
+        def browse():
+            folder = filedialog.askdirectory(parent=dialog, title="Cartella Backup")
+            if folder:
+                folder_var.set(folder)
+
+        ttk.Button(frame, text="📂", width=3, command=browse).grid(row=0, column=2, padx=(5, 0))
+
+        ttk.Label(frame, text="Intervallo (ore, 0 = disattivo):").grid(row=1, column=0, sticky=tk.W, pady=5)
+        interval_var = tk.IntVar(value=settings['interval_hours'])
+        ttk.Spinbox(frame, from_=0, to=720, textvariable=interval_var, width=10).grid(row=1, column=1, sticky=tk.W, pady=5)
+
+        ttk.Label(frame, text="Copie da conservare:").grid(row=2, column=0, sticky=tk.W, pady=5)
+        copies_var = tk.IntVar(value=settings['copies'])
+        ttk.Spinbox(frame, from_=1, to=365, textvariable=copies_var, width=10).grid(row=2, column=1, sticky=tk.W, pady=5)
+
+        last_error = self.get_setting('backup_ultimo_errore')
+        if last_error:
+            ttk.Label(frame, text=f"⚠️ Ultimo backup automatico non riuscito: {last_error}", foreground='red',
+                      wraplength=420).grid(row=3, column=0, columnspan=3, sticky=tk.W, pady=5)
+
+        def save_settings():
             try:
-                self.cursor.execute('''
-                    INSERT INTO allegati (intervento_id, nome_file, tipo_file, contenuto)
-                    SELECT intervento_id, nome_file, 'image', immagine FROM immagini
-                ''')
-                self.cursor.execute('DROP TABLE immagini')
-                self.conn.commit()
-            except:
-                pass
-        
+                interval_hours = max(0, int(interval_var.get()))
+                copies = max(1, int(copies_var.get()))
+            except (tk.TclError, ValueError):
+                messagebox.showwarning("Valori non validi", "Inserisci valori numerici validi!", parent=dialog)
+                return
+            self.set_setting('backup_cartella', folder_var.get().strip() or BACKUP_DEFAULTS['folder'])
+            self.set_setting('backup_intervallo_ore', interval_hours)
+            self.set_setting('backup_copie', copies)
+            dialog.destroy()
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.grid(row=4, column=0, columnspan=3, pady=(10, 0))
+        ttk.Button(btn_frame, text="💾 Salva", command=save_settings).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Annulla", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+
+    def notify_records_changed(self, inserted=(), deleted=(), updated=()):
+        """Aggiorna le cache in memoria dopo una scrittura su interventi, senza ricaricare tutto"""
+        self.records.remove(deleted)
+        self.records.reload_rows(self.conn, updated)
+        self.records.refresh(self.conn)
+        self.update_minhash_index(inserted, deleted, updated)
+        self.update_image_index(inserted)
+        if hasattr(self, 'facet_boxes'):
+            self.refresh_facet_controls()
+
+    def start_minhash_index(self):
+        """Costruisce l'indice all'avvio nel pool di worker; fino ad allora il controllo duplicati e' saltato"""
+        self.minhash_pending = []
+
+        def on_done(index):
+            self.minhash_index = index
+            # Modifiche salvate durante la costruzione: l'indice potrebbe non averle viste
+            pending, self.minhash_pending = self.minhash_pending, None
+            for inserted, deleted, updated in pending:
+                self.update_minhash_index(inserted, deleted, updated)
+
+        def on_error(error):
+            self.minhash_pending = None
+            messagebox.showerror("Errore", f"Errore nella preparazione dell'indice duplicati: {error}")
+
+        self.run_in_background(build_minhash_index, self.db_path, on_done=on_done, on_error=on_error)
+
+    def update_minhash_index(self, inserted=(), deleted=(), updated=()):
+        changed = list(inserted) + list(updated)
+        if updated:
+            # Firme non piu' valide: vengono ricalcolate ora o alla prossima costruzione dell'indice
+            self.conn.executemany('DELETE FROM minhash_firme WHERE intervento_id = ?', [(record_id,) for record_id in updated])
+            self.conn.commit()
+        if self.minhash_index is None:
+            if self.minhash_pending is not None:
+                self.minhash_pending.append((list(inserted), list(deleted), list(updated)))
+            return
+
+        for record_id in deleted:
+            self.minhash_index.remove(record_id)
+
+        for record_id in changed:
+            row = self.conn.execute('SELECT problema, macchina FROM interventi WHERE id = ?', (record_id,)).fetchone()
+            if row is None:
+                continue
+            signature = self.minhash_index.signature(row[0])
+            self.conn.execute('INSERT OR REPLACE INTO minhash_firme (intervento_id, firma) VALUES (?, ?)',
+                              (record_id, signature.tobytes()))
+            self.minhash_index.add(record_id, signature, row[1])
+        if changed:
+            self.conn.commit()
+
+    def get_image_index(self):
+        if self.image_index is None:
+            index = MultiIndexHash()
+            for allegato_id, phash in self.conn.execute('''
+                SELECT id, phash FROM allegati WHERE tipo_file = 'image' AND phash IS NOT NULL
+            '''):
+                index.add(phash, allegato_id)
+            self.image_index = index
+        return self.image_index
+
+    def update_image_index(self, inserted=(), images=()):
+        # Le immagini degli interventi eliminati restano nell'indice e vengono scartate in ricerca
+        if self.image_index is None:
+            return
+        for allegato_id, phash in images:
+            self.image_index.add(phash, allegato_id)
+        for record_id in inserted:
+            for allegato_id, phash in self.conn.execute('''
+                SELECT id, phash FROM allegati WHERE intervento_id = ? AND tipo_file = 'image' AND phash IS NOT NULL
+            ''', (record_id,)).fetchall():
+                self.image_index.add(phash, allegato_id)
+
+    def find_similar_images(self, hashes, threshold=IMAGE_SIMILARITY_THRESHOLD, exclude_allegato=None):
+        """Interventi con immagini entro la soglia di Hamming, dal più simile: [(distanza, intervento_id)]"""
+        dhash, phash = hashes
+        matches = {allegato_id: distance for distance, allegato_id in self.get_image_index().search(phash, threshold)
+                   if allegato_id != exclude_allegato}
+        if not matches:
+            return []
+
+        placeholders = ', '.join('?' * len(matches))
+        rows = self.conn.execute(f'SELECT id, intervento_id, dhash FROM allegati WHERE id IN ({placeholders})',
+                                 list(matches)).fetchall()
+        best = {}
+        for allegato_id, intervento_id, item_dhash in rows:
+            distance = matches[allegato_id]
+            # pHash per la ricerca nell'indice, dHash per affinare l'ordinamento
+            score = distance + (hamming_distance(dhash, item_dhash) if item_dhash is not None else threshold)
+            if intervento_id not in best or score < best[intervento_id]:
+                best[intervento_id] = score
+        return sorted((score, intervento_id) for intervento_id, score in best.items())
+
+    def show_similar_images(self, hashes, exclude_allegato=None):
+        matches = self.find_similar_images(hashes, exclude_allegato=exclude_allegato)
+        if not matches:
+            messagebox.showinfo("Ricerca Immagini", "Nessun intervento con immagini simili.")
+            return
+
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+
+        for score, record_id in matches:
+            row = self.conn.execute('''
+                SELECT id, data_ora, macchina, operatore, categoria, problema FROM interventi WHERE id = ?
+            ''', (record_id,)).fetchone()
+            if row:
+                problema_short = row[5][:80] + '...' if len(row[5]) > 80 else row[5]
+                self.tree.insert('', tk.END, iid=row[0], values=(row[1], row[2], row[3], row[4], problema_short))
+
+        self.notebook.select(self.tab_search)
+        self.root.lift()
+
+    def search_by_image_file(self):
+        file_path = filedialog.askopenfilename(
+            title="Seleziona Immagine da Cercare",
+            filetypes=[("Immagini", "*.png *.jpg *.jpeg *.gif *.bmp"), ("Tutti i file", "*.*")]
+        )
+        if not file_path:
+            return
+
+        try:
+            with open(file_path, 'rb') as f:
+                img_data = f.read()
+        except OSError as e:
+            messagebox.showerror("Errore", f"Errore nel caricamento: {e}")
+            return
+
+        self.run_in_background(perceptual_hashes, img_data, on_done=self.show_similar_images,
+                               on_error=lambda e: messagebox.showerror("Errore", f"Immagine non valida: {e}"))
+
+    def search_by_screenshot(self):
+        self.root.withdraw()
+        self.root.after(500, self._search_screen)
+
+    def _search_screen(self):
+        try:
+            buffer = io.BytesIO()
+            ImageGrab.grab().save(buffer, format='PNG')
+        except Exception as e:
+            messagebox.showerror("Errore", f"Errore durante lo screenshot: {e}")
+            return
+        finally:
+            self.root.deiconify()
+
+        self.run_in_background(perceptual_hashes, buffer.getvalue(), on_done=self.show_similar_images,
+                               on_error=lambda e: messagebox.showerror("Errore", f"Errore nel calcolo dell'hash: {e}"))
+
+    def search_similar_to_attachment(self, allegato_id):
+        row = self.conn.execute('SELECT dhash, phash FROM allegati WHERE id = ?', (allegato_id,)).fetchone()
+        if row is None or row[1] is None:
+            messagebox.showinfo("Ricerca Immagini", "Hash non ancora calcolato per questa immagine.\n\n"
+                                "Usa Strumenti > Calcola hash immagini mancanti.")
+            return
+        self.show_similar_images(row, exclude_allegato=allegato_id)
+
+    def backfill_image_hashes(self):
+        """Job una tantum: calcola dHash/pHash delle immagini salvate prima dell'indice"""
+        if getattr(self, 'image_backfill_running', False):
+            messagebox.showinfo("Hash Immagini", "Calcolo già in corso.")
+            return
+
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Hash immagini")
+        progress_window.resizable(False, False)
+        frame = ttk.Frame(progress_window, padding="15")
+        frame.pack(fill='both', expand=True)
+        ttk.Label(frame, text="Puoi continuare a lavorare durante il calcolo.").pack(pady=(0, 10))
+        progress_bar = ttk.Progressbar(frame, length=350, mode='determinate')
+        progress_bar.pack()
+        status_var = tk.StringVar(value="Avvio...")
+        ttk.Label(frame, textvariable=status_var).pack(pady=(10, 0))
+
+        # Aggiornato dal thread del job, letto dal ciclo eventi di Tk
+        progress_state = {'done': 0, 'total': 0}
+
+        def update_progress(done, total):
+            progress_state['done'], progress_state['total'] = done, total
+
+        def refresh():
+            if not progress_window.winfo_exists() or not self.image_backfill_running:
+                return
+            if progress_state['total']:
+                progress_bar['maximum'] = progress_state['total']
+                progress_bar['value'] = progress_state['done']
+                status_var.set(f"Immagini elaborate: {progress_state['done']} / {progress_state['total']}")
+            self.root.after(200, refresh)
+
+        def on_done(stats):
+            self.image_backfill_running = False
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            self.image_index = None
+            messagebox.showinfo("Hash Immagini", f"Immagini elaborate: {stats['done']}\nNon leggibili: {stats['failed']}")
+
+        def on_error(error):
+            self.image_backfill_running = False
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            self.image_index = None
+            messagebox.showerror("Errore", f"Errore durante il calcolo degli hash: {error}")
+
+        self.image_backfill_running = True
         self.conn.commit()
-    
+        self.run_in_background(backfill_image_hashes_job, self.db_path, update_progress,
+                               on_done=on_done, on_error=on_error)
+        refresh()
+
+    def run_fault_clustering(self):
+        if getattr(self, 'clustering_running', False):
+            messagebox.showinfo("Guasti Ricorrenti", "Analisi già in corso.")
+            return
+
+        self.clustering_running = True
+        self.conn.commit()
+
+        def on_done(summary):
+            self.clustering_running = False
+            self.update_statistics()
+            messagebox.showinfo("Guasti Ricorrenti",
+                f"Analisi completata!\n\nInterventi analizzati: {summary['total']}\n"
+                f"Guasti ricorrenti trovati: {summary['clusters']}\n"
+                f"Interventi raggruppati: {summary['assigned']}")
+
+        def on_error(error):
+            self.clustering_running = False
+            messagebox.showerror("Errore", f"Errore durante l'analisi: {error}")
+
+        self.run_in_background(cluster_interventions, self.db_path, on_done=on_done, on_error=on_error)
+
+    def recurring_fault_rows(self):
+        """Conteggi dei guasti ricorrenti per macchina e mese: [(cluster, etichetta, macchina, mese, conteggio)]"""
+        return self.conn.execute('''
+            SELECT c.id, c.etichetta, i.macchina, strftime('%Y-%m', i.data_ora) AS mese, COUNT(*)
+            FROM interventi_cluster ic
+            JOIN cluster_guasti c ON c.id = ic.cluster_id
+            JOIN interventi i ON i.id = ic.intervento_id
+            GROUP BY c.id, i.macchina, mese
+            ORDER BY c.dimensione DESC, c.id, mese DESC, COUNT(*) DESC
+        ''').fetchall()
+
+    def create_recurring_faults_table(self):
+        clusters = self.conn.execute('''
+            SELECT c.id, c.etichetta, COUNT(ic.intervento_id), c.creato_il
+            FROM cluster_guasti c JOIN interventi_cluster ic ON ic.cluster_id = c.id
+            GROUP BY c.id ORDER BY COUNT(ic.intervento_id) DESC
+        ''').fetchall()
+        if not clusters:
+            return
+
+        per_machine, per_month = {}, {}
+        # Chiave per id: due cluster possono avere gli stessi termini principali
+        for cluster_id, _, macchina, mese, count in self.recurring_fault_rows():
+            per_machine.setdefault(cluster_id, {}).setdefault(macchina, 0)
+            per_machine[cluster_id][macchina] += count
+            per_month.setdefault(cluster_id, {}).setdefault(mese, 0)
+            per_month[cluster_id][mese] += count
+
+        table_frame = ttk.LabelFrame(self.stats_container, text=f"Guasti Ricorrenti (analisi del {clusters[0][3]})", padding="10")
+        table_frame.pack(fill='x', padx=10, pady=(0, 10))
+
+        tree_scroll = ttk.Scrollbar(table_frame)
+        tree_scroll.pack(side='right', fill='y')
+        columns = ('Guasto', 'Interventi', 'Macchine', 'Mesi')
+        tree = ttk.Treeview(table_frame, columns=columns, show='headings', height=5, yscrollcommand=tree_scroll.set)
+        tree.pack(side='left', fill='x', expand=True)
+        tree_scroll.config(command=tree.yview)
+
+        for column, heading, width in (('Guasto', 'Termini principali', 300), ('Interventi', 'Interventi', 80),
+                                       ('Macchine', 'Macchine più colpite', 300), ('Mesi', 'Ultimi mesi', 300)):
+            tree.heading(column, text=heading)
+            tree.column(column, anchor=tk.CENTER if column == 'Interventi' else tk.W, width=width)
+
+        for cluster_id, label, count, _ in clusters:
+            machines = sorted(per_machine.get(cluster_id, {}).items(), key=lambda item: -item[1])[:3]
+            months = sorted(per_month.get(cluster_id, {}).items(), reverse=True)[:3]
+            tree.insert('', tk.END, values=(label, count,
+                                            ', '.join(f"{m} ({n})" for m, n in machines),
+                                            ', '.join(f"{m}: {n}" for m, n in months)))
+
+    def show_duplicate_clusters(self):
+        """Job batch: raggruppa i duplicati esistenti e mostra quali righe verrebbero unite (nessuna modifica)"""
+        if self.minhash_index is None:
+            messagebox.showinfo("Duplicati", "Indice dei duplicati in preparazione, riprova tra qualche istante.")
+            return
+
+        if getattr(self, 'duplicates_running', False):
+            return
+
+        self.duplicates_running = True
+        self.conn.commit()
+        self.root.config(cursor='watch')
+
+        def on_done(groups):
+            self.duplicates_running = False
+            self.root.config(cursor='')
+            self.open_duplicate_report(groups)
+
+        def on_error(error):
+            self.duplicates_running = False
+            self.root.config(cursor='')
+            messagebox.showerror("Errore", f"Errore durante la ricerca dei duplicati: {error}")
+
+        # Copie dei dizionari: l'indice continua a cambiare nel thread di Tk mentre il job lavora
+        self.run_in_background(duplicate_clusters_job, self.db_path, dict(self.minhash_index.signatures),
+                               dict(self.minhash_index.machines), on_done=on_done, on_error=on_error)
+
+    def open_duplicate_report(self, groups):
+        if not groups:
+            messagebox.showinfo("Duplicati", "Nessun gruppo di interventi duplicati trovato.")
+            return
+
+        report_window = tk.Toplevel(self.root)
+        report_window.title("Interventi Duplicati")
+        report_window.geometry("1000x600")
+
+        to_merge = sum(len(rows) - 1 for rows in groups)
+        ttk.Label(report_window, text=f"{len(groups)} gruppi, {to_merge} interventi da unire "
+                  f"(in ogni gruppo si conserva il più vecchio)", font=('Arial', 11, 'bold')).pack(pady=10)
+
+        tree_frame = ttk.Frame(report_window)
+        tree_frame.pack(fill='both', expand=True, padx=10, pady=(0, 10))
+        tree_scroll = ttk.Scrollbar(tree_frame)
+        tree_scroll.pack(side='right', fill='y')
+
+        tree = ttk.Treeview(tree_frame, columns=('Azione', 'Data', 'Macchina', 'Problema'), yscrollcommand=tree_scroll.set)
+        tree.pack(side='left', fill='both', expand=True)
+        tree_scroll.config(command=tree.yview)
+
+        tree.heading('#0', text='Intervento')
+        tree.column('#0', width=130)
+        for column, width in (('Azione', 110), ('Data', 140), ('Macchina', 140), ('Problema', 450)):
+            tree.heading(column, text=column)
+            tree.column(column, anchor=tk.W, width=width)
+
+        for number, rows in enumerate(groups, 1):
+            group = tree.insert('', tk.END, text=f"Gruppo {number}", values=(f"{len(rows)} interventi", '', rows[0][2], ''), open=True)
+            for position, (record_id, data_ora, macchina, problema) in enumerate(rows):
+                action = "Conserva" if position == 0 else f"Unisci in #{rows[0][0]}"
+                problema_short = problema[:80] + '...' if len(problema) > 80 else problema
+                tree.insert(group, tk.END, text=f"#{record_id}", values=(action, data_ora, macchina, problema_short))
+
+    def run_in_background(self, func, *args, on_done=None, on_error=None):
+        """Esegue func nel pool di worker e richiama on_done/on_error nel thread di Tk"""
+        future = self.executor.submit(func, *args)
+        self.root.after(20, self._poll_future, future, on_done, on_error)
+        return future
+
+    def _poll_future(self, future, on_done, on_error):
+        if not future.done():
+            self.root.after(20, self._poll_future, future, on_done, on_error)
+            return
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if error is not None:
+            if on_error:
+                on_error(error)
+        elif on_done:
+            on_done(future.result())
+
+    def add_column_if_missing(self, table, column, definition):
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def create_menu(self):
+        menubar = tk.Menu(self.root)
+        self.root.config(menu=menubar)
+
+        self.tools_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Strumenti", menu=self.tools_menu)
+        self.tools_menu.add_command(label="Ricomprimi allegati esistenti", command=self.recompress_attachments)
+        self.tools_menu.add_command(label="Policy immagini...", command=self.edit_image_policy)
+        self.tools_menu.add_command(label="Cerca interventi duplicati", command=self.show_duplicate_clusters)
+        self.tools_menu.add_command(label="Calcola hash immagini mancanti", command=self.backfill_image_hashes)
+        self.tools_menu.add_command(label="Analizza guasti ricorrenti", command=self.run_fault_clustering)
+        self.tools_menu.add_separator()
+        self.tools_menu.add_command(label="Compatta database", command=self.compact_database)
+        self.tools_menu.add_command(label="Report reattività interfaccia", command=self.show_lag_report)
+        self.tools_menu.add_separator()
+        self.tools_menu.add_command(label="Backup ora...", command=self.backup_now)
+        self.tools_menu.add_command(label="Impostazioni backup...", command=self.edit_backup_settings)
+        self.tools_menu.add_separator()
+        self.tools_menu.add_command(label="Esporta modifiche per altra sede...", command=self.export_sync_bundle)
+        self.tools_menu.add_command(label="Importa modifiche da altra sede...", command=self.import_sync_bundle)
+        self.tools_menu.add_separator()
+        self.tools_menu.add_command(label="Esporta archivio completo (ZIP)...", command=self.export_to_zip)
+
     def create_widgets(self):
-        
+        self.create_menu()
+
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
         
@@ -137,7 +2931,21 @@ class MachineTrackerApp:
         ttk.Button(attach_buttons, text="🖼️ Immagine", command=self.load_image).pack(side=tk.LEFT, padx=2)
         ttk.Button(attach_buttons, text="📄 File TXT", command=self.load_txt_file).pack(side=tk.LEFT, padx=2)
         ttk.Button(attach_buttons, text="📝 File DOCX", command=self.load_docx_file).pack(side=tk.LEFT, padx=2)
+        ttk.Button(attach_buttons, text="📁 Cartella", command=self.load_folder).pack(side=tk.LEFT, padx=2)
         ttk.Button(attach_buttons, text="❌ Rimuovi", command=self.remove_attachment).pack(side=tk.LEFT, padx=2)
+
+        ingest_frame = ttk.Frame(right_frame)
+        ingest_frame.pack(fill='x', pady=(0, 10))
+
+        self.keep_original_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(ingest_frame, text="Mantieni immagini originali",
+                        variable=self.keep_original_var).pack(side=tk.LEFT, padx=2)
+        self.ingest_status_var = tk.StringVar(value="")
+        self.ingest_errors = []
+        ttk.Label(ingest_frame, textvariable=self.ingest_status_var,
+                  font=('Arial', 9, 'italic')).pack(side=tk.RIGHT, padx=2)
+        self.ingest_progress = ttk.Progressbar(ingest_frame, mode='determinate', length=120, maximum=0)
+        self.ingest_progress.pack(side=tk.RIGHT, padx=2)
         
         preview_frame = ttk.Frame(right_frame)
         preview_frame.pack(fill='both', expand=True)
@@ -169,8 +2977,41 @@ class MachineTrackerApp:
         self.search_entry.bind('<KeyRelease>', lambda e: self.search_records())
         
         ttk.Button(search_frame, text="🔍 Cerca", command=self.search_records).grid(row=0, column=2, padx=5)
-        ttk.Button(search_frame, text="📋 Mostra Tutti", command=self.load_all_records).grid(row=0, column=3, padx=5)
+        ttk.Button(search_frame, text="📋 Mostra Tutti", command=self.reset_filters).grid(row=0, column=3, padx=5)
         ttk.Button(search_frame, text="📊 Export Excel", command=self.export_to_excel).grid(row=0, column=4, padx=5)
+        ttk.Button(search_frame, text="🗜️ Export ZIP", command=self.export_to_zip).grid(row=0, column=5, padx=5)
+
+        image_search_frame = ttk.Frame(search_frame)
+        image_search_frame.grid(row=1, column=0, columnspan=6, sticky=tk.W, pady=(5, 0))
+        ttk.Label(image_search_frame, text="Cerca per immagine:").pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(image_search_frame, text="🖼️ Da File", command=self.search_by_image_file).pack(side=tk.LEFT, padx=5)
+        ttk.Button(image_search_frame, text="📷 Da Screenshot", command=self.search_by_screenshot).pack(side=tk.LEFT, padx=5)
+
+        facet_frame = ttk.Frame(search_frame)
+        facet_frame.grid(row=2, column=0, columnspan=6, sticky=tk.W, pady=(5, 0))
+        self.facet_boxes = {}
+        self.facet_choices = {}
+        for facet, label in (('macchina', 'Macchina:'), ('categoria', 'Categoria:'),
+                             ('operatore', 'Operatore:'), ('allegato', 'Allegati:')):
+            ttk.Label(facet_frame, text=label).pack(side=tk.LEFT, padx=(0, 5))
+            box = ttk.Combobox(facet_frame, state='readonly', width=22)
+            box.pack(side=tk.LEFT, padx=(0, 10))
+            box.bind('<<ComboboxSelected>>', lambda e, f=facet: self.on_facet_selected(f))
+            self.facet_boxes[facet] = box
+
+        ttk.Label(facet_frame, text="Dal:").pack(side=tk.LEFT, padx=(0, 5))
+        self.date_from_entry = ttk.Entry(facet_frame, width=11)
+        self.date_from_entry.pack(side=tk.LEFT, padx=(0, 10))
+        ttk.Label(facet_frame, text="Al:").pack(side=tk.LEFT, padx=(0, 5))
+        self.date_to_entry = ttk.Entry(facet_frame, width=11)
+        self.date_to_entry.pack(side=tk.LEFT, padx=(0, 10))
+        for entry in (self.date_from_entry, self.date_to_entry):
+            entry.bind('<Return>', lambda e: self.on_date_range_changed())
+            entry.bind('<FocusOut>', lambda e: self.on_date_range_changed())
+        ttk.Style().configure('Errore.TEntry', foreground='red')
+        self.date_hint_label = ttk.Label(facet_frame, text="(AAAA-MM-GG)", foreground='gray')
+        self.date_hint_label.pack(side=tk.LEFT)
+        self.refresh_facet_controls()
         
         results_frame = ttk.Frame(main_frame)
         results_frame.grid(row=1, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
@@ -180,7 +3021,7 @@ class MachineTrackerApp:
         tree_scroll = ttk.Scrollbar(results_frame)
         tree_scroll.pack(side='right', fill='y')
         
-        self.tree = ttk.Treeview(results_frame, yscrollcommand=tree_scroll.set, selectmode='browse')
+        self.tree = ttk.Treeview(results_frame, yscrollcommand=tree_scroll.set, selectmode='extended')
         self.tree.pack(side='left', fill='both', expand=True)
         tree_scroll.config(command=self.tree.yview)
         
@@ -211,6 +3052,8 @@ class MachineTrackerApp:
         
         ttk.Button(btn_frame, text="📎 Visualizza Allegati", command=self.view_attachments).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="🗑️ Elimina Intervento", command=self.delete_record).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="🏷️ Cambia Categoria", command=self.bulk_change_category).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="🔧 Cambia Macchina", command=self.bulk_change_machine).pack(side=tk.LEFT, padx=5)
     
     def create_ai_tab(self):
         main_frame = ttk.Frame(self.tab_ai, padding="10")
@@ -261,18 +3104,7 @@ class MachineTrackerApp:
     def _capture_screen(self):
         try:
             screenshot = ImageGrab.grab()
-            
-            img_byte_arr = io.BytesIO()
-            screenshot.save(img_byte_arr, format='PNG')
-            img_data = img_byte_arr.getvalue()
-            
-            self.current_attachments.append({
-                'name': f'screenshot_{len(self.current_attachments)+1}.png',
-                'type': 'image',
-                'data': img_data
-            })
-            
-            self.update_attachments_preview()
+            self.ingest_image(f'screenshot_{len(self.current_attachments) + self.pending_ingest + 1}.png', screenshot)
             
         except Exception as e:
             messagebox.showerror("Errore", f"Errore durante lo screenshot: {e}")
@@ -280,138 +3112,228 @@ class MachineTrackerApp:
             self.root.deiconify()
     
     def load_image(self):
-        file_path = filedialog.askopenfilename(
-            title="Seleziona Immagine",
-            filetypes=[("Immagini", "*.png *.jpg *.jpeg *.gif *.bmp"), ("Tutti i file", "*.*")]
+        file_paths = filedialog.askopenfilenames(
+            title="Seleziona Immagini",
+            filetypes=[("Immagini", "*.png *.jpg *.jpeg *.gif *.bmp *.webp"), ("Tutti i file", "*.*")]
         )
-        
-        if file_path:
+        self.ingest_files(file_paths)
+
+    def load_folder(self):
+        folder = filedialog.askdirectory(title="Seleziona Cartella da Allegare")
+        if not folder:
+            return
+
+        file_paths = []
+        for dirpath, _, filenames in os.walk(folder):
+            file_paths.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                              if os.path.splitext(name)[1].lower() in ATTACHMENT_EXTENSIONS)
+        if not file_paths:
+            self.ingest_status_var.set(f"Nessun file allegabile in {os.path.basename(folder)}")
+            return
+        self.ingest_files(file_paths)
+
+    def _start_ingest(self, count):
+        if not self.pending_ingest:
+            self.ingest_progress.config(maximum=0, value=0)
+            self.ingest_errors = []
+        self.pending_ingest += count
+        self.ingest_progress.config(maximum=float(self.ingest_progress['maximum']) + count)
+        self._update_ingest_status()
+
+    def _finish_ingest(self):
+        self.pending_ingest -= 1
+        self.ingest_in_flight -= 1
+        self.ingest_progress.config(value=float(self.ingest_progress['value']) + 1)
+        self._update_ingest_status()
+        self._submit_ingest()
+
+    def _queue_ingest(self, func, name, *args):
+        self.ingest_queue.append((func, name, args))
+        self._submit_ingest()
+
+    def _submit_ingest(self):
+        """Passa al pool i file in coda finche' ce ne sono al massimo 2 per worker in elaborazione.
+
+        Ogni risultato resta in memoria solo fino al suo callback, che libera il posto per il file successivo.
+        """
+        while self.ingest_queue and self.ingest_in_flight < 2 * self.worker_count:
+            func, name, args = self.ingest_queue.popleft()
+            self.ingest_in_flight += 1
+            self.run_in_background(func, *args, on_done=self._on_attachment_ready,
+                                   on_error=lambda error, n=name: self._on_attachment_failed(n, error))
+
+    def _update_ingest_status(self):
+        done, total = int(float(self.ingest_progress['value'])), int(float(self.ingest_progress['maximum']))
+        if self.pending_ingest:
+            status = f"Elaborazione allegati: {done}/{total}"
+        else:
+            totals = self.ingest_totals
+            status = (f"{totals['count']} immagini: {format_size(totals['before'])} → {format_size(totals['after'])}"
+                      if totals['count'] else "")
+        if self.ingest_errors:
+            status += f" | {len(self.ingest_errors)} scartati ({self.ingest_errors[-1]})"
+        self.ingest_status_var.set(status.strip(' |'))
+
+    def ingest_files(self, file_paths):
+        """Legge, controlla e prepara piu' file in parallelo nel pool di worker"""
+        if not file_paths:
+            return
+        policy = None if self.keep_original_var.get() else self.get_image_policy()
+        self._start_ingest(len(file_paths))
+        for file_path in file_paths:
+            self._queue_ingest(load_attachment_file, os.path.basename(file_path), file_path, policy)
+
+    def ingest_image(self, name, source):
+        """Normalizza l'immagine nel pool di worker e la aggiunge agli allegati quando e' pronta"""
+        policy = None if self.keep_original_var.get() else self.get_image_policy()
+        self._start_ingest(1)
+        self._queue_ingest(prepare_image_attachment, name, name, source, policy)
+
+    def _on_attachment_ready(self, attachment):
+        content_hash = attachment.get('content_hash')
+        if content_hash and any(a.get('content_hash') == content_hash for a in self.current_attachments):
+            self.ingest_errors.append(f"{attachment['name']}: già allegato")
+        else:
+            if attachment['type'] == 'image':
+                totals = self.ingest_totals
+                totals['count'] += 1
+                totals['before'] += attachment['original_size']
+                totals['after'] += len(attachment['data'])
+            self.current_attachments.append(attachment)
+            self.update_attachments_preview()
+        self._finish_ingest()
+
+    def _on_attachment_failed(self, name, error):
+        self.ingest_errors.append(f"{name}: {error}")
+        self._finish_ingest()
+
+    def edit_image_policy(self):
+        policy = self.get_image_policy()
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Policy Immagini")
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+
+        frame = ttk.Frame(dialog, padding="15")
+        frame.pack(fill='both', expand=True)
+
+        ttk.Label(frame, text="Lato massimo (px):").grid(row=0, column=0, sticky=tk.W, pady=5)
+        max_side_var = tk.IntVar(value=policy['max_side'])
+        ttk.Spinbox(frame, from_=320, to=8000, increment=160, textvariable=max_side_var, width=10).grid(row=0, column=1, sticky=tk.W, pady=5)
+
+        ttk.Label(frame, text="Formato:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        format_combo = ttk.Combobox(frame, values=IMAGE_FORMATS, state="readonly", width=8)
+        format_combo.set(policy['format'])
+        format_combo.grid(row=1, column=1, sticky=tk.W, pady=5)
+
+        ttk.Label(frame, text="Qualità (JPEG/WEBP):").grid(row=2, column=0, sticky=tk.W, pady=5)
+        quality_var = tk.IntVar(value=policy['quality'])
+        ttk.Spinbox(frame, from_=30, to=100, increment=5, textvariable=quality_var, width=10).grid(row=2, column=1, sticky=tk.W, pady=5)
+
+        def save_policy():
             try:
-                with open(file_path, 'rb') as f:
-                    img_data = f.read()
-                
-                file_name = os.path.basename(file_path)
-                
-                self.current_attachments.append({
-                    'name': file_name,
-                    'type': 'image',
-                    'data': img_data
-                })
-                
-                self.update_attachments_preview()
-                
-            except Exception as e:
-                messagebox.showerror("Errore", f"Errore nel caricamento: {e}")
+                max_side = max(64, int(max_side_var.get()))
+                quality = min(100, max(1, int(quality_var.get())))
+            except (tk.TclError, ValueError):
+                messagebox.showwarning("Valori non validi", "Inserisci valori numerici validi!", parent=dialog)
+                return
+            self.set_setting('immagini_lato_max', max_side)
+            self.set_setting('immagini_formato', format_combo.get())
+            self.set_setting('immagini_qualita', quality)
+            dialog.destroy()
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.grid(row=3, column=0, columnspan=2, pady=(10, 0))
+        ttk.Button(btn_frame, text="💾 Salva", command=save_policy).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Annulla", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
     
     def load_txt_file(self):
-        file_path = filedialog.askopenfilename(
-            title="Seleziona File TXT",
-            filetypes=[("File di testo", "*.txt"), ("Tutti i file", "*.*")]
-        )
-        
-        if file_path:
-            try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                
-                file_name = os.path.basename(file_path)
-                
-                self.current_attachments.append({
-                    'name': file_name,
-                    'type': 'txt',
-                    'data': file_data
-                })
-                
-                self.update_attachments_preview()
-                messagebox.showinfo("Successo", f"File TXT '{file_name}' caricato con successo!")
-                
-            except Exception as e:
-                messagebox.showerror("Errore", f"Errore nel caricamento del file TXT: {e}")
-    
-    def load_docx_file(self):
-        file_path = filedialog.askopenfilename(
-            title="Seleziona File DOCX",
-            filetypes=[("File Word", "*.docx"), ("Tutti i file", "*.*")]
-        )
-        
-        if file_path:
-            try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                
-                file_name = os.path.basename(file_path)
-                
-                self.current_attachments.append({
-                    'name': file_name,
-                    'type': 'docx',
-                    'data': file_data
-                })
-                
-                self.update_attachments_preview()
-                messagebox.showinfo("Successo", f"File DOCX '{file_name}' caricato con successo!")
-                
-            except Exception as e:
-                messagebox.showerror("Errore", f"Errore nel caricamento del file DOCX: {e}")
+        file_paths = filedialog.askopenfilenames(
+            title="Seleziona File TXT",
+            filetypes=[("File di testo", "*.txt *.log *.csv"), ("Tutti i file", "*.*")]
+        )
+        self.ingest_files(file_paths)
+    
+    def load_docx_file(self):
+        file_paths = filedialog.askopenfilenames(
+            title="Seleziona File DOCX",
+            filetypes=[("File Word", "*.docx"), ("Tutti i file", "*.*")]
+        )
+        self.ingest_files(file_paths)
     
     def remove_attachment(self):
         if not self.current_attachments:
             messagebox.showwarning("Attenzione", "Nessun allegato da rimuovere!")
             return
         
-        if len(self.current_attachments) == 1:
-            self.current_attachments.pop(0)
-        else:
-            idx = messagebox.askquestion("Rimuovi", 
-                f"Rimuovere l'ultimo allegato ({self.current_attachments[-1]['name']})?")
-            if idx == 'yes':
-                self.current_attachments.pop(-1)
-        
+        last = self.current_attachments[-1]
+        if len(self.current_attachments) == 1 or messagebox.askquestion("Rimuovi", 
+                f"Rimuovere l'ultimo allegato ({last['name']})?") == 'yes':
+            self.remove_attachment_by_id(last['id'])
+
+    def remove_attachment_by_id(self, attachment_id):
+        self.current_attachments = [a for a in self.current_attachments if a['id'] != attachment_id]
         self.update_attachments_preview()
     
     def update_attachments_preview(self):
-        for widget in self.preview_container.winfo_children():
-            widget.destroy()
+        """Allinea l'anteprima alla lista degli allegati: crea o distrugge solo le voci cambiate"""
+        for attachment in self.current_attachments:
+            attachment.setdefault('id', next(self.attachment_ids))
+
+        current_ids = {attachment['id'] for attachment in self.current_attachments}
+        for attachment_id in [i for i in self.preview_widgets if i not in current_ids]:
+            self.preview_widgets.pop(attachment_id)['frame'].destroy()
+
+        for attachment in self.current_attachments:
+            if attachment['id'] not in self.preview_widgets:
+                self.preview_widgets[attachment['id']] = self.create_attachment_preview(attachment)
+
+    def create_attachment_preview(self, attachment):
+        frame = ttk.LabelFrame(self.preview_container, text=f"{attachment['name']} [{attachment['type'].upper()}]", padding="5")
+        frame.pack(fill='x', pady=5)
+        preview = {'frame': frame, 'photo': None}
+
+        ttk.Button(frame, text="❌", width=3,
+                   command=lambda i=attachment['id']: self.remove_attachment_by_id(i)).pack(anchor=tk.NE)
         
-        self.preview_widgets = []
+        if attachment['type'] == 'image' and 'thumbnail' in attachment:
+            preview['photo'] = ImageTk.PhotoImage(attachment.pop('thumbnail'))
+            ttk.Label(frame, image=preview['photo']).pack()
+
+        elif attachment['type'] == 'image':
+            label = ttk.Label(frame, text="Caricamento anteprima...")
+            label.pack()
+
+            def show(image, i=attachment['id']):
+                if i in self.preview_widgets:
+                    self.preview_widgets[i]['photo'] = ImageTk.PhotoImage(image)
+                    label.config(image=self.preview_widgets[i]['photo'], text='')
+
+            def failed(error, i=attachment['id']):
+                if i in self.preview_widgets:
+                    label.config(text=f"Errore visualizzazione: {error}")
+
+            self.run_in_background(make_thumbnail, attachment['data'], PREVIEW_THUMBNAIL_SIZE, on_done=show, on_error=failed)
         
-        for idx, attachment in enumerate(self.current_attachments):
-            frame = ttk.LabelFrame(self.preview_container, text=f"{attachment['name']} [{attachment['type'].upper()}]", padding="5")
-            frame.pack(fill='x', pady=5)
-            
-            if attachment['type'] == 'image':
-                try:
-                    image = Image.open(io.BytesIO(attachment['data']))
-                    image.thumbnail((250, 250))
-                    
-                    photo = ImageTk.PhotoImage(image)
-                    self.preview_widgets.append(photo)
-                    
-                    label = ttk.Label(frame, image=photo)
-                    label.pack()
-                    
-                except Exception as e:
-                    ttk.Label(frame, text=f"Errore visualizzazione: {e}").pack()
+        elif attachment['type'] == 'txt':
+            content = attachment['data'][:800].decode('utf-8', errors='ignore')
+            preview_text = content[:200] + "..." if len(content) > 200 else content
             
-            elif attachment['type'] == 'txt':
-                try:
-                    content = attachment['data'].decode('utf-8', errors='ignore')
-                    preview = content[:200] + "..." if len(content) > 200 else content
-                    
-                    text_widget = tk.Text(frame, height=6, wrap=tk.WORD, bg='#f0f0f0')
-                    text_widget.insert('1.0', preview)
-                    text_widget.config(state='disabled')
-                    text_widget.pack(fill='x')
-                    
-                except Exception as e:
-                    ttk.Label(frame, text=f"Errore lettura: {e}").pack()
+            text_widget = tk.Text(frame, height=6, wrap=tk.WORD, bg='#f0f0f0')
+            text_widget.insert('1.0', preview_text)
+            text_widget.config(state='disabled')
+            text_widget.pack(fill='x')
+        
+        elif attachment['type'] == 'docx':
+            info_frame = ttk.Frame(frame)
+            info_frame.pack(fill='x', pady=5)
             
-            elif attachment['type'] == 'docx':
-                info_frame = ttk.Frame(frame)
-                info_frame.pack(fill='x', pady=5)
-                
-                size_kb = len(attachment['data']) / 1024
-                ttk.Label(info_frame, text=f"📝 Documento Word", font=('Arial', 10, 'bold')).pack()
-                ttk.Label(info_frame, text=f"Dimensione: {size_kb:.2f} KB").pack()
+            size_kb = len(attachment['data']) / 1024
+            ttk.Label(info_frame, text=f"📝 Documento Word", font=('Arial', 10, 'bold')).pack()
+            ttk.Label(info_frame, text=f"Dimensione: {size_kb:.2f} KB").pack()
+
+        return preview
     
     def save_record(self):
         macchina = self.macchina_entry.get().strip()
@@ -423,7 +3345,22 @@ class MachineTrackerApp:
         if not macchina or not operatore or not problema or not soluzione:
             messagebox.showwarning("Campi Mancanti", "Compila tutti i campi obbligatori!")
             return
+
+        if self.pending_ingest:
+            messagebox.showwarning("Attendere", "Elaborazione degli allegati ancora in corso, riprova tra qualche istante.")
+            return
         
+        index = self.minhash_index
+        duplicate = index.best_duplicate(index.signature(problema), macchina) if index is not None else None
+        if duplicate:
+            dup_id, score = duplicate
+            dup_data, dup_problema = self.conn.execute('SELECT data_ora, problema FROM interventi WHERE id = ?', (dup_id,)).fetchone()
+            dup_short = dup_problema[:200] + '...' if len(dup_problema) > 200 else dup_problema
+            if not messagebox.askyesno("Possibile Duplicato",
+                    f"Possibile duplicato dell'intervento #{dup_id} ({dup_data}, similarità {int(score * 100)}%):\n\n"
+                    f"{dup_short}\n\nSalvare comunque?"):
+                return
+
         data_ora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
         try:
@@ -435,12 +3372,11 @@ class MachineTrackerApp:
             intervento_id = self.cursor.lastrowid
             
             for attachment in self.current_attachments:
-                self.cursor.execute('''
-                    INSERT INTO allegati (intervento_id, nome_file, tipo_file, contenuto)
-                    VALUES (?, ?, ?, ?)
-                ''', (intervento_id, attachment['name'], attachment['type'], attachment['data']))
-            
+                self.insert_attachment(intervento_id, attachment['name'], attachment['type'], attachment['data'],
+                                       attachment.get('hashes'))
+
             self.conn.commit()
+            self.notify_records_changed(inserted=[intervento_id])
             
             num_images = sum(1 for a in self.current_attachments if a['type'] == 'image')
             num_txt = sum(1 for a in self.current_attachments if a['type'] == 'txt')
@@ -461,7 +3397,59 @@ class MachineTrackerApp:
             
         except sqlite3.Error as e:
             messagebox.showerror("Errore Database", f"Errore: {e}")
-    
+
+    def insert_attachment(self, intervento_id, nome_file, tipo_file, data, hashes=None):
+        if tipo_file == 'image' and hashes is None:
+            try:
+                hashes = perceptual_hashes(data)
+            except Exception:
+                hashes = None
+        dhash, phash = hashes or (None, None)
+
+        codec, contenuto = compress_payload(data)
+        self.cursor.execute('''
+            INSERT INTO allegati (intervento_id, nome_file, tipo_file, contenuto, codec, hash_contenuto, dhash, phash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (intervento_id, nome_file, tipo_file, contenuto, codec, hashlib.sha256(data).hexdigest(), dhash, phash))
+        return self.cursor.lastrowid
+
+    def iter_attachment_chunks(self, allegato_id):
+        """Legge e decomprime un allegato a blocchi, senza caricarlo tutto in memoria"""
+        yield from iter_blob_chunks(self.conn, allegato_id)
+
+    def read_attachment(self, allegato_id):
+        return b''.join(self.iter_attachment_chunks(allegato_id))
+
+    def recompress_attachments(self):
+        """Job una tantum: comprime gli allegati salvati prima dell'introduzione dei codec"""
+        if getattr(self, 'recompress_running', False):
+            messagebox.showinfo("Ricompressione", "Ricompressione già in corso.")
+            return
+        if not messagebox.askyesno("Ricompressione",
+                "Comprimere gli allegati esistenti non ancora compressi?\n\nL'operazione puo' richiedere alcuni minuti."):
+            return
+
+        self.recompress_running = True
+        self.conn.commit()
+        self.root.config(cursor='watch')
+
+        def on_done(stats):
+            self.recompress_running = False
+            self.root.config(cursor='')
+            saved_mb = (stats['before'] - stats['after']) / (1024 * 1024)
+            messagebox.showinfo("Ricompressione",
+                f"Allegati esaminati: {stats['rows']}\n"
+                f"Prima: {stats['before'] / (1024 * 1024):.2f} MB\n"
+                f"Dopo: {stats['after'] / (1024 * 1024):.2f} MB\n"
+                f"Spazio recuperato: {saved_mb:.2f} MB")
+
+        def on_error(error):
+            self.recompress_running = False
+            self.root.config(cursor='')
+            messagebox.showerror("Errore", f"Errore durante la ricompressione: {error}")
+
+        self.run_in_background(recompress_attachments_job, self.db_path, on_done=on_done, on_error=on_error)
+
     def clear_fields(self):
         self.macchina_entry.delete(0, tk.END)
         self.operatore_entry.delete(0, tk.END)
@@ -469,21 +3457,91 @@ class MachineTrackerApp:
         self.problema_text.delete('1.0', tk.END)
         self.soluzione_text.delete('1.0', tk.END)
         self.current_attachments = []
+        self.ingest_totals = {'count': 0, 'before': 0, 'after': 0}
+        self.ingest_errors = []
+        self.ingest_status_var.set("")
         self.update_attachments_preview()
     
+    def refresh_facet_controls(self):
+        """Aggiorna le voci dei filtri con i conteggi correnti"""
+        for facet, box in self.facet_boxes.items():
+            every = "Tutte" if facet in ('macchina', 'categoria') else "Tutti"
+            choices = {every: None}
+            for value, count in self.facets.facet_counts(facet):
+                label = FACET_ATTACHMENT_LABELS[value] if facet == 'allegato' else value
+                choices[f"{label} ({count})"] = value
+            self.facet_choices[facet] = choices
+            box['values'] = list(choices)
+            selected = self.facets.filters[facet]
+            box.set(next(text for text, value in choices.items() if value == selected))
+
+    def on_facet_selected(self, facet):
+        self.facets.set_filter(facet, self.facet_choices[facet].get(self.facet_boxes[facet].get()))
+        self.refresh_facet_controls()
+        self.search_records()
+
+    def parse_filter_date(self, entry):
+        text = entry.get().strip()
+        if not text:
+            return None
+        try:
+            return int(np.datetime64(datetime.strptime(text, "%Y-%m-%d"), 's').astype(np.int64))
+        except ValueError:
+            raise ValueError(f"Data non valida: '{text}' (formato AAAA-MM-GG)")
+
+    def on_date_range_changed(self):
+        # Segnalazione in linea, senza finestre: un messagebox ruberebbe il focus e rilancerebbe <FocusOut>
+        dates, errors = [], []
+        for entry in (self.date_from_entry, self.date_to_entry):
+            try:
+                dates.append(self.parse_filter_date(entry))
+                entry.configure(style='TEntry')
+            except ValueError as e:
+                errors.append(str(e))
+                entry.configure(style='Errore.TEntry')
+        if errors:
+            self.date_hint_label.configure(text=errors[0], foreground='red')
+            return
+        self.date_hint_label.configure(text="(AAAA-MM-GG)", foreground='gray')
+
+        date_from, date_to = dates
+        if date_to is not None:
+            date_to += DAY_SECONDS
+        if (date_from, date_to) == (self.facets.date_from, self.facets.date_to):
+            return
+        self.facets.set_date_range(date_from, date_to)
+        self.refresh_facet_controls()
+        self.search_records()
+
+    def reset_filters(self):
+        for facet in FacetIndex.FACETS:
+            self.facets.filters[facet] = None
+        self.facets.set_date_range(None, None)
+        for entry in (self.date_from_entry, self.date_to_entry):
+            entry.delete(0, tk.END)
+            entry.configure(style='TEntry')
+        self.date_hint_label.configure(text="(AAAA-MM-GG)", foreground='gray')
+        self.search_entry.delete(0, tk.END)
+        self.refresh_facet_controls()
+        self.load_all_records()
+
     def load_all_records(self):
+        self.show_record_rows(self.facets.matching_rows())
+
+    def show_record_rows(self, rows):
+        """Riempie l'elenco con le righe indicate della cache, dalla piu' recente"""
         for item in self.tree.get_children():
             self.tree.delete(item)
         
-        self.cursor.execute('''
-            SELECT id, data_ora, macchina, operatore, categoria, problema 
-            FROM interventi 
-            ORDER BY data_ora DESC
-        ''')
-        
-        for row in self.cursor.fetchall():
-            problema_short = row[5][:80] + '...' if len(row[5]) > 80 else row[5]
-            self.tree.insert('', tk.END, iid=row[0], values=(row[1], row[2], row[3], row[4], problema_short))
+        records = self.records
+        records.load_text(self.conn, 'problema')
+        rows = records.by_date_desc(rows)
+        for row, data_ora in zip(rows.tolist(), records.date_strings(rows)):
+            problema = records.text('problema', row)
+            problema_short = problema[:80] + '...' if len(problema) > 80 else problema
+            self.tree.insert('', tk.END, iid=int(records.ids[row]),
+                             values=(data_ora, records.value('macchina', row), records.value('operatore', row),
+                                     records.value('categoria', row), problema_short))
     
     def search_records(self):
         search_term = self.search_entry.get().strip().lower()
@@ -492,25 +3550,17 @@ class MachineTrackerApp:
             self.load_all_records()
             return
         
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        self.cursor.execute('''
-            SELECT id, data_ora, macchina, operatore, categoria, problema 
-            FROM interventi 
-            WHERE LOWER(problema) LIKE ? OR LOWER(soluzione) LIKE ? OR LOWER(macchina) LIKE ?
-            ORDER BY data_ora DESC
-        ''', (f'%{search_term}%', f'%{search_term}%', f'%{search_term}%'))
-        
-        results = self.cursor.fetchall()
+        self.records.load_text(self.conn, *RECORD_TEXT_COLUMNS)
+        rows = self.facets.matching_rows()
+        rows = rows[self.records.text_matches(search_term)[rows]]
         
-        if not results:
+        if not len(rows):
+            for item in self.tree.get_children():
+                self.tree.delete(item)
             messagebox.showinfo("Ricerca", "Nessun risultato trovato.")
             return
         
-        for row in results:
-            problema_short = row[5][:80] + '...' if len(row[5]) > 80 else row[5]
-            self.tree.insert('', tk.END, iid=row[0], values=(row[1], row[2], row[3], row[4], problema_short))
+        self.show_record_rows(rows)
     
     def show_details(self, event):
         selection = self.tree.selection()
@@ -572,7 +3622,7 @@ SOLUZIONE:
         
         record_id = selection[0]
         
-        self.cursor.execute('SELECT nome_file, tipo_file, contenuto FROM allegati WHERE intervento_id = ?', (record_id,))
+        self.cursor.execute('SELECT id, nome_file, tipo_file FROM allegati WHERE intervento_id = ?', (record_id,))
         attachments = self.cursor.fetchall()
         
         if not attachments:
@@ -586,62 +3636,28 @@ SOLUZIONE:
         notebook = ttk.Notebook(attach_window)
         notebook.pack(fill='both', expand=True, padx=10, pady=10)
         
-        images = [(nome, data) for nome, tipo, data in attachments if tipo == 'image']
+        images = [(allegato_id, nome) for allegato_id, nome, tipo in attachments if tipo == 'image']
         if images:
             img_tab = ttk.Frame(notebook)
             notebook.add(img_tab, text=f"🖼️ Immagini ({len(images)})")
-            
-            canvas = tk.Canvas(img_tab)
-            scrollbar = ttk.Scrollbar(img_tab, orient="vertical", command=canvas.yview)
-            container = ttk.Frame(canvas)
-            
-            container.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-            canvas.create_window((0, 0), window=container, anchor="nw")
-            canvas.configure(yscrollcommand=scrollbar.set)
-            
-            canvas.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
-            
-            temp_photos = []
-            
-            for idx, (nome, img_data) in enumerate(images):
-                frame = ttk.LabelFrame(container, text=nome, padding="10")
-                frame.pack(fill='x', pady=10, padx=10)
-                
-                try:
-                    image = Image.open(io.BytesIO(img_data))
-                    image.thumbnail((800, 800))
-                    
-                    photo = ImageTk.PhotoImage(image)
-                    temp_photos.append(photo)
-                    
-                    label = ttk.Label(frame, image=photo)
-                    label.pack()
-                    
-                    btn_frame = ttk.Frame(frame)
-                    btn_frame.pack(pady=5)
-                    ttk.Button(btn_frame, text="💾 Salva Immagine", 
-                             command=lambda d=img_data, n=nome: self.save_attachment_to_file(d, n)).pack()
-                    
-                except Exception as e:
-                    ttk.Label(frame, text=f"Errore: {e}").pack()
-            
-            attach_window.photos = temp_photos
+            attach_window.gallery = AttachmentGallery(self, img_tab, images)
         
-        txt_files = [(nome, data) for nome, tipo, data in attachments if tipo == 'txt']
+        txt_files = [(allegato_id, nome) for allegato_id, nome, tipo in attachments if tipo == 'txt']
         if txt_files:
             txt_tab = ttk.Frame(notebook)
             notebook.add(txt_tab, text=f"📄 File TXT ({len(txt_files)})")
             
-            for idx, (nome, file_data) in enumerate(txt_files):
+            for idx, (allegato_id, nome) in enumerate(txt_files):
                 frame = ttk.LabelFrame(txt_tab, text=nome, padding="10")
                 frame.pack(fill='both', expand=True, padx=10, pady=5)
                 
                 try:
-                    content = file_data.decode('utf-8', errors='ignore')
-                    
                     text_widget = scrolledtext.ScrolledText(frame, wrap=tk.WORD, height=20)
-                    text_widget.insert('1.0', content)
+                    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+                    for chunk in self.iter_attachment_chunks(allegato_id):
+                        text_widget.insert(tk.END, decoder.decode(chunk))
+                    text_widget.insert(tk.END, decoder.decode(b'', final=True))
+                    content = text_widget.get('1.0', 'end-1c')
                     text_widget.config(state='disabled')
                     text_widget.pack(fill='both', expand=True)
                     
@@ -649,14 +3665,14 @@ SOLUZIONE:
                     btn_frame = ttk.Frame(frame)
                     btn_frame.pack(pady=5)
                     ttk.Button(btn_frame, text="💾 Salva File", 
-                             command=lambda d=file_data, n=nome: self.save_attachment_to_file(d, n)).pack(side=tk.LEFT, padx=5)
+                             command=lambda a=allegato_id, n=nome: self.save_attachment_to_file(a, n)).pack(side=tk.LEFT, padx=5)
                     ttk.Button(btn_frame, text="📋 Copia Contenuto", 
                              command=lambda c=content: self.copy_to_clipboard(c)).pack(side=tk.LEFT, padx=5)
                     
                 except Exception as e:
                     ttk.Label(frame, text=f"Errore lettura: {e}").pack()
         
-        docx_files = [(nome, data) for nome, tipo, data in attachments if tipo == 'docx']
+        docx_files = [(allegato_id, nome) for allegato_id, nome, tipo in attachments if tipo == 'docx']
         if docx_files:
             docx_tab = ttk.Frame(notebook)
             notebook.add(docx_tab, text=f"📝 File DOCX ({len(docx_files)})")
@@ -672,10 +3688,12 @@ SOLUZIONE:
             canvas.pack(side="left", fill="both", expand=True)
             scrollbar.pack(side="right", fill="y")
             
-            for idx, (nome, file_data) in enumerate(docx_files):
+            for idx, (allegato_id, nome) in enumerate(docx_files):
                 frame = ttk.LabelFrame(container, text=nome, padding="15")
                 frame.pack(fill='x', pady=10, padx=10)
                 
+                file_data = self.read_attachment(allegato_id)
+                
                 size_kb = len(file_data) / 1024
                 
                 info_frame = ttk.Frame(frame)
@@ -705,11 +3723,11 @@ SOLUZIONE:
                 btn_frame = ttk.Frame(frame)
                 btn_frame.pack(pady=10)
                 ttk.Button(btn_frame, text="💾 Salva File DOCX", 
-                         command=lambda d=file_data, n=nome: self.save_attachment_to_file(d, n)).pack(side=tk.LEFT, padx=5)
+                         command=lambda a=allegato_id, n=nome: self.save_attachment_to_file(a, n)).pack(side=tk.LEFT, padx=5)
                 ttk.Button(btn_frame, text="📂 Apri con Word", 
                          command=lambda d=file_data, n=nome: self.open_docx_external(d, n)).pack(side=tk.LEFT, padx=5)
     
-    def save_attachment_to_file(self, data, filename):
+    def save_attachment_to_file(self, allegato_id, filename):
         file_path = filedialog.asksaveasfilename(
             defaultextension=os.path.splitext(filename)[1],
             initialfile=filename,
@@ -719,7 +3737,8 @@ SOLUZIONE:
         if file_path:
             try:
                 with open(file_path, 'wb') as f:
-                    f.write(data)
+                    for chunk in self.iter_attachment_chunks(allegato_id):
+                        f.write(chunk)
                 messagebox.showinfo("Successo", f"File salvato in:\n{file_path}")
             except Exception as e:
                 messagebox.showerror("Errore", f"Errore nel salvataggio: {e}")
@@ -752,29 +3771,113 @@ SOLUZIONE:
         except Exception as e:
             messagebox.showerror("Errore", f"Impossibile aprire il file: {e}")
     
+    def selected_record_ids(self):
+        return [int(iid) for iid in self.tree.selection()]
+
+    def load_selection_table(self, ids):
+        """Carica gli id selezionati in una tabella temporanea, per operazioni set-based senza limiti di parametri"""
+        self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS selezione (id INTEGER PRIMARY KEY)')
+        self.cursor.execute('DELETE FROM temp.selezione')
+        self.cursor.executemany('INSERT INTO temp.selezione (id) VALUES (?)', [(i,) for i in ids])
+
     def delete_record(self):
-        selection = self.tree.selection()
-        if not selection:
+        ids = self.selected_record_ids()
+        if not ids:
             messagebox.showwarning("Selezione", "Seleziona un intervento!")
             return
         
-        if messagebox.askyesno("Conferma", "Eliminare questo intervento e tutti i suoi allegati?"):
-            record_id = selection[0]
-            
+        question = ("Eliminare questo intervento e tutti i suoi allegati?" if len(ids) == 1 else
+                    f"Eliminare {len(ids)} interventi e tutti i loro allegati?")
+        if messagebox.askyesno("Conferma", question):
             try:
-                self.cursor.execute('DELETE FROM allegati WHERE intervento_id = ?', (record_id,))
-                self.cursor.execute('DELETE FROM interventi WHERE id = ?', (record_id,))
+                self.load_selection_table(ids)
+                self.cursor.execute('DELETE FROM allegati WHERE intervento_id IN (SELECT id FROM temp.selezione)')
+                self.cursor.execute('DELETE FROM interventi WHERE id IN (SELECT id FROM temp.selezione)')
                 self.conn.commit()
-                
-                messagebox.showinfo("Successo", "Intervento eliminato!")
-                self.load_all_records()
-                
-                self.details_text.config(state='normal')
-                self.details_text.delete('1.0', tk.END)
-                self.details_text.config(state='disabled')
-                
             except sqlite3.Error as e:
+                self.conn.rollback()
                 messagebox.showerror("Errore", f"Errore: {e}")
+                return
+
+            self.notify_records_changed(deleted=ids)
+            self.tree.delete(*[str(i) for i in ids if self.tree.exists(str(i))])
+            
+            self.details_text.config(state='normal')
+            self.details_text.delete('1.0', tk.END)
+            self.details_text.config(state='disabled')
+            messagebox.showinfo("Successo", "Intervento eliminato!" if len(ids) == 1 else f"{len(ids)} interventi eliminati!")
+
+    def bulk_change_category(self):
+        self.bulk_change_field('categoria', "Cambia Categoria", "Nuova categoria:",
+                               list(self.categoria_combo['values']), editable=False)
+
+    def bulk_change_machine(self):
+        self.bulk_change_field('macchina', "Cambia Macchina", "Nuova macchina:",
+                               [value for value, _ in self.facets.facet_counts('macchina')], editable=True)
+
+    def bulk_change_field(self, column, title, label, values, editable):
+        ids = self.selected_record_ids()
+        if not ids:
+            messagebox.showwarning("Selezione", "Seleziona almeno un intervento!")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title(title)
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+
+        frame = ttk.Frame(dialog, padding="15")
+        frame.pack(fill='both', expand=True)
+
+        ttk.Label(frame, text=f"Interventi selezionati: {len(ids)}").grid(row=0, column=0, columnspan=2, sticky=tk.W, pady=5)
+        ttk.Label(frame, text=label).grid(row=1, column=0, sticky=tk.W, pady=5)
+        value_combo = ttk.Combobox(frame, values=values, width=30, state='normal' if editable else 'readonly')
+        value_combo.grid(row=1, column=1, sticky=(tk.W, tk.E), pady=5)
+
+        def apply_change():
+            value = value_combo.get().strip()
+            if not value:
+                messagebox.showwarning("Campi Mancanti", "Inserisci un valore!", parent=dialog)
+                return
+            dialog.destroy()
+            self.apply_bulk_update(column, value, ids)
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.grid(row=2, column=0, columnspan=2, pady=(10, 0))
+        ttk.Button(btn_frame, text="💾 Applica", command=apply_change).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Annulla", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+
+    def apply_bulk_update(self, column, value, ids):
+        """Aggiorna una colonna su tutti gli interventi selezionati in un'unica transazione"""
+        try:
+            self.load_selection_table(ids)
+            changed = [row[0] for row in self.cursor.execute(f'''
+                SELECT id FROM interventi WHERE id IN (SELECT id FROM temp.selezione) AND {column} != ?
+            ''', (value,))]
+            self.cursor.execute(f'''
+                UPDATE interventi SET {column} = ? WHERE id IN (SELECT id FROM temp.selezione) AND {column} != ?
+            ''', (value, value))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            messagebox.showerror("Errore", f"Errore: {e}")
+            return
+
+        self.notify_records_changed(updated=changed)
+
+        # Aggiornamento sul posto: le righe che non rispettano piu' i filtri attivi escono dalla lista
+        heading = column.capitalize()
+        hidden = self.facets.filters[column] not in (None, value)
+        for record_id in changed:
+            iid = str(record_id)
+            if not self.tree.exists(iid):
+                continue
+            if hidden:
+                self.tree.delete(iid)
+            else:
+                self.tree.set(iid, heading, value)
+
+        messagebox.showinfo("Successo", f"{len(changed)} interventi aggiornati.")
     
     def ai_find_solutions(self):
         question = self.ai_question.get('1.0', tk.END).strip()
@@ -783,18 +3886,24 @@ SOLUZIONE:
             messagebox.showwarning("Attenzione", "Inserisci una descrizione del problema!")
             return
         
-        self.cursor.execute('SELECT id, problema, soluzione, macchina, categoria, data_ora FROM interventi')
-        all_records = self.cursor.fetchall()
+        # I filtri della scheda Ricerca restringono i candidati prima del calcolo di similarita'
+        records = self.records
+        records.load_text(self.conn, *RECORD_TEXT_COLUMNS)
+        candidates = self.facets.matching_rows()
+        active_filters = self.facets.describe()
         
-        if not all_records:
-            messagebox.showinfo("IA", "Nessun intervento nel database.")
+        if not len(candidates):
+            if active_filters:
+                messagebox.showinfo("IA", f"Nessun intervento corrisponde ai filtri attivi ({active_filters}).")
+            else:
+                messagebox.showinfo("IA", "Nessun intervento nel database.")
             return
         
         similarities = []
-        for record in all_records:
-            similarity = self.calculate_similarity(question.lower(), record[1].lower())
+        for row in candidates.tolist():
+            similarity = self.calculate_similarity(question.lower(), records.text('problema', row).lower())
             if similarity > 0.3:  # Soglia minima
-                similarities.append((similarity, record))
+                similarities.append((similarity, row))
         
         similarities.sort(reverse=True, key=lambda x: x[0])
         
@@ -809,10 +3918,14 @@ SOLUZIONE:
             self.ai_results.insert(tk.END, "- Aggiungi più interventi al database per migliorare i risultati")
         else:
             self.ai_results.insert('1.0', f"✅ Trovate {len(similarities[:5])} soluzioni simili:\n\n")
+            if active_filters:
+                self.ai_results.insert(tk.END, f"🔎 Filtri attivi: {active_filters}\n\n")
             self.ai_results.insert(tk.END, "="*80 + "\n\n")
             
-            for idx, (similarity, record) in enumerate(similarities[:5]):
-                record_id, problema, soluzione, macchina, categoria, data_ora = record
+            for idx, (similarity, row) in enumerate(similarities[:5]):
+                problema, soluzione = records.text('problema', row), records.text('soluzione', row)
+                macchina, categoria = records.value('macchina', row), records.value('categoria', row)
+                data_ora = records.date_strings([row])[0]
                 percentage = int(similarity * 100)
                 
                 self.ai_results.insert(tk.END, f"🔍 RISULTATO #{idx+1} - Similarità: {percentage}%\n")
@@ -833,8 +3946,8 @@ SOLUZIONE:
         for widget in self.stats_container.winfo_children():
             widget.destroy()
         
-        self.cursor.execute('SELECT COUNT(*) FROM interventi')
-        total = self.cursor.fetchone()[0]
+        self.records.refresh(self.conn)
+        total = len(self.analytics)
         
         if total == 0:
             ttk.Label(self.stats_container, text="Nessun dato disponibile", 
@@ -856,8 +3969,7 @@ SOLUZIONE:
         self.cursor.execute('SELECT COUNT(*) FROM allegati WHERE tipo_file = "docx"')
         total_docx = self.cursor.fetchone()[0]
         
-        self.cursor.execute('SELECT COUNT(DISTINCT macchina) FROM interventi')
-        unique_machines = self.cursor.fetchone()[0]
+        unique_machines = len(self.analytics.machine_counts())
         
         info_text = f"""
         📊 Totale Interventi: {total}
@@ -870,17 +3982,14 @@ SOLUZIONE:
         """
         
         ttk.Label(info_frame, text=info_text, font=('Arial', 11)).pack()
+
+        self.create_reliability_table()
+        self.create_recurring_faults_table()
         
         charts_frame = ttk.Frame(self.stats_container)
         charts_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        self.cursor.execute('''
-            SELECT categoria, COUNT(*) 
-            FROM interventi 
-            GROUP BY categoria 
-            ORDER BY COUNT(*) DESC
-        ''')
-        cat_data = self.cursor.fetchall()
+        cat_data = self.analytics.category_counts()
         
         if cat_data:
             fig1, ax1 = plt.subplots(figsize=(6, 4))
@@ -899,14 +4008,7 @@ SOLUZIONE:
             canvas1.draw()
             canvas1.get_tk_widget().pack(side=tk.LEFT, fill='both', expand=True, padx=5)
         
-        self.cursor.execute('''
-            SELECT macchina, COUNT(*) as cnt
-            FROM interventi 
-            GROUP BY macchina 
-            ORDER BY cnt DESC 
-            LIMIT 5
-        ''')
-        machine_data = self.cursor.fetchall()
+        machine_data = self.analytics.machine_counts(limit=5)
         
         if machine_data:
             fig2, ax2 = plt.subplots(figsize=(6, 4))
@@ -923,19 +4025,10 @@ SOLUZIONE:
             canvas2.draw()
             canvas2.get_tk_widget().pack(side=tk.LEFT, fill='both', expand=True, padx=5)
         
-        self.cursor.execute('''
-            SELECT strftime('%Y-%m', data_ora) as mese, COUNT(*) 
-            FROM interventi 
-            GROUP BY mese 
-            ORDER BY mese DESC 
-            LIMIT 12
-        ''')
-        month_data = self.cursor.fetchall()
+        months, counts = self.analytics.monthly_counts(12)
         
-        if month_data and len(month_data) > 1:
+        if len(months) > 1:
             fig3, ax3 = plt.subplots(figsize=(12, 4))
-            months = [row[0] for row in reversed(month_data)]
-            counts = [row[1] for row in reversed(month_data)]
             
             ax3.plot(months, counts, marker='o', linewidth=2, markersize=8, color='#4ECDC4')
             ax3.fill_between(range(len(months)), counts, alpha=0.3, color='#4ECDC4')
@@ -950,6 +4043,168 @@ SOLUZIONE:
             canvas3.draw()
             canvas3.get_tk_widget().pack(fill='both', expand=True, padx=10, pady=10)
     
+    def reliability_rows(self):
+        """Righe della tabella affidabilità, condivise tra Statistiche ed esportazioni"""
+        summary = self.analytics.machine_summary()
+        weekly = self.analytics.rolling_rate(weeks=1, window=4)
+
+        def days(value):
+            return '-' if np.isnan(value) else f"{value:.1f}"
+
+        rows = []
+        for item in summary:
+            code = self.analytics.machine_index[item['macchina']]
+            if item['tasso_recente'] > item['tasso_precedente']:
+                trend = '▲'
+            elif item['tasso_recente'] < item['tasso_precedente']:
+                trend = '▼'
+            else:
+                trend = '='
+            rows.append((item['macchina'], item['interventi'], days(item['mtbf_giorni']),
+                         days(item['mediana_giorni']), days(item['p90_giorni']),
+                         f"{item['ricorrenze']} ({item['ricorrenza_pct']:.0f}%)",
+                         f"{item['tasso_recente']:.1f}", f"{weekly[code, -1]:.2f}", trend))
+        return rows
+
+    def create_reliability_table(self):
+        table_frame = ttk.LabelFrame(self.stats_container, text="Affidabilità per Macchina", padding="10")
+        table_frame.pack(fill='x', padx=10, pady=(0, 10))
+
+        columns = ('Macchina', 'Interventi', 'MTBF', 'Mediana', 'P90', 'Ricorrenze', 'Tasso', 'Media4', 'Trend')
+        headings = ('Macchina', 'Interventi', 'MTBF (gg)', 'Mediana (gg)', 'P90 (gg)',
+                    f'Ricorrenze {RECURRENCE_WINDOW_DAYS}gg', f'Tasso {RATE_WINDOW_DAYS}gg (/mese)', 'Media 4 sett.', 'Trend')
+
+        tree_frame = ttk.Frame(table_frame)
+        tree_frame.pack(fill='x')
+        tree_scroll = ttk.Scrollbar(tree_frame)
+        tree_scroll.pack(side='right', fill='y')
+
+        tree = ttk.Treeview(tree_frame, columns=columns, show='headings', height=6, yscrollcommand=tree_scroll.set)
+        tree.pack(side='left', fill='x', expand=True)
+        tree_scroll.config(command=tree.yview)
+
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, anchor=tk.W if column == 'Macchina' else tk.CENTER, width=180 if column == 'Macchina' else 95)
+
+        for row in self.reliability_rows():
+            tree.insert('', tk.END, values=row)
+
+        ttk.Button(table_frame, text="💾 Esporta CSV", command=self.export_reliability_csv).pack(anchor=tk.E, pady=(5, 0))
+
+    def export_reliability_csv(self):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".csv",
+            filetypes=[("File CSV", "*.csv"), ("Tutti i file", "*.*")],
+            initialfile=f"affidabilita_macchine_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        )
+        if not file_path:
+            return
+
+        try:
+            with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.writer(f, delimiter=';')
+                writer.writerow(['Macchina', 'Interventi', 'MTBF (giorni)', 'Mediana intervallo (giorni)',
+                                 'P90 intervallo (giorni)', f'Ricorrenze {RECURRENCE_WINDOW_DAYS}gg',
+                                 f'Tasso {RATE_WINDOW_DAYS}gg (/mese)', 'Media 4 settimane', 'Trend'])
+                writer.writerows(self.reliability_rows())
+            messagebox.showinfo("Successo", f"Analisi esportata in:\n{file_path}")
+        except OSError as e:
+            messagebox.showerror("Errore Export", f"Errore durante l'export: {e}")
+
+    def export_to_zip(self):
+        """Archivio ZIP con manifest e allegati originali, generato in background e riprendibile"""
+        if getattr(self, 'archive_running', False):
+            messagebox.showinfo("Export ZIP", "Un'esportazione è già in corso.")
+            return
+
+        state = None
+        file_path = self.get_setting('archivio_in_corso')
+        if file_path:
+            state = read_archive_resume(file_path, self.db_path)
+            if state and not messagebox.askyesno("Export ZIP",
+                    f"Esportazione interrotta verso:\n{file_path}\n\n"
+                    f"Interventi già esportati: {state['interventi']}\n\nRiprendere da dove si era fermata?"):
+                state = None
+                try:
+                    discard_archive(file_path)
+                except OSError:
+                    pass
+                self.set_setting('archivio_in_corso', '')
+
+        if state is None:
+            file_path = filedialog.asksaveasfilename(
+                defaultextension=".zip",
+                filetypes=[("Archivio ZIP", "*.zip"), ("Tutti i file", "*.*")],
+                initialfile=f"archivio_interventi_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+            )
+            if not file_path:
+                return
+            where, params = '1', []
+            active_filters = self.facets.describe()
+            if active_filters and messagebox.askyesno("Export ZIP",
+                    f"Esportare solo gli interventi che rispettano i filtri attivi?\n\n{active_filters}"):
+                where, params = self.facets.sql_filter()
+            self.set_setting('archivio_in_corso', file_path)
+        else:
+            where, params = state['where'], state['params']
+
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Export ZIP in corso")
+        progress_window.resizable(False, False)
+        frame = ttk.Frame(progress_window, padding="15")
+        frame.pack(fill='both', expand=True)
+        ttk.Label(frame, text="Puoi continuare a lavorare durante l'esportazione.").pack(pady=(0, 10))
+        progress_bar = ttk.Progressbar(frame, length=350, mode='determinate')
+        progress_bar.pack()
+        status_var = tk.StringVar(value="Avvio...")
+        ttk.Label(frame, textvariable=status_var).pack(pady=(10, 0))
+
+        self.archive_cancel = threading.Event()
+        ttk.Button(frame, text="⏹️ Interrompi", command=self.archive_cancel.set).pack(pady=(10, 0))
+        progress_window.protocol("WM_DELETE_WINDOW", self.archive_cancel.set)
+
+        # Aggiornato dal thread di export, letto dal ciclo eventi di Tk
+        progress_state = {'done': 0, 'total': 0}
+
+        def update_progress(done, total):
+            progress_state['done'], progress_state['total'] = done, total
+
+        def refresh():
+            if not progress_window.winfo_exists() or not self.archive_running:
+                return
+            if progress_state['total']:
+                progress_bar['maximum'] = progress_state['total']
+                progress_bar['value'] = progress_state['done']
+                status_var.set(f"Interventi esportati: {progress_state['done']} / {progress_state['total']}")
+            self.root.after(200, refresh)
+
+        def on_done(result):
+            self.archive_running = False
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            if result['completato']:
+                self.set_setting('archivio_in_corso', '')
+                messagebox.showinfo("Export ZIP", f"Esportazione completata!\n\n"
+                                    f"Interventi: {result['interventi']}\nAllegati: {result['allegati']}\n\n{file_path}")
+            else:
+                messagebox.showinfo("Export ZIP", f"Esportazione interrotta dopo {result['interventi']} interventi.\n\n"
+                                    "Rilanciando l'export potrai riprenderla da questo punto.")
+
+        def on_error(error):
+            self.archive_running = False
+            if progress_window.winfo_exists():
+                progress_window.destroy()
+            messagebox.showerror("Errore Export ZIP", f"Errore durante l'esportazione: {error}\n\n"
+                                 "Rilanciando l'export potrai riprenderla dall'ultimo punto salvato.")
+
+        self.archive_running = True
+        self.conn.commit()
+        self.run_in_background(export_archive, self.db_path, file_path, where, params,
+                               state, update_progress, self.archive_cancel,
+                               on_done=on_done, on_error=on_error)
+        refresh()
+
     def export_to_excel(self):
         file_path = filedialog.asksaveasfilename(
             defaultextension=".xlsx",
@@ -961,12 +4216,10 @@ SOLUZIONE:
             return
         
         try:
-            self.cursor.execute('''
-                SELECT id, data_ora, macchina, operatore, categoria, problema, soluzione 
-                FROM interventi 
-                ORDER BY data_ora DESC
-            ''')
-            records = self.cursor.fetchall()
+            records = self.records
+            records.refresh(self.conn)
+            records.load_text(self.conn, *RECORD_TEXT_COLUMNS)
+            rows = records.by_date_desc(np.arange(len(records)))
             
             wb = openpyxl.Workbook()
             ws = wb.active
@@ -983,14 +4236,10 @@ SOLUZIONE:
                 cell.font = header_font
                 cell.alignment = Alignment(horizontal='center', vertical='center')
             
-            for row_idx, record in enumerate(records, 2):
-                self.cursor.execute('''
-                    SELECT tipo_file, COUNT(*) 
-                    FROM allegati 
-                    WHERE intervento_id = ? 
-                    GROUP BY tipo_file
-                ''', (record[0],))
-                attach_counts = dict(self.cursor.fetchall())
+            for row_idx, (row, data_ora) in enumerate(zip(rows.tolist(), records.date_strings(rows)), 2):
+                record = (int(records.ids[row]), data_ora, records.value('macchina', row), records.value('operatore', row),
+                          records.value('categoria', row), records.text('problema', row), records.text('soluzione', row))
+                attach_counts = dict(zip(ATTACHMENT_TYPES, records.attachment_counts[row].tolist()))
                 
                 attach_str = []
                 if attach_counts.get('image', 0) > 0:
@@ -1041,6 +4290,33 @@ SOLUZIONE:
             
             ws_stats.column_dimensions['A'].width = 30
             ws_stats.column_dimensions['B'].width = 15
+
+            ws_reliability = wb.create_sheet("Affidabilità")
+            reliability_headers = ['Macchina', 'Interventi', 'MTBF (gg)', 'Mediana (gg)', 'P90 (gg)',
+                                   f'Ricorrenze {RECURRENCE_WINDOW_DAYS}gg', f'Tasso {RATE_WINDOW_DAYS}gg (/mese)',
+                                   'Media 4 sett.', 'Trend']
+            for col, header in enumerate(reliability_headers, 1):
+                cell = ws_reliability.cell(row=1, column=col)
+                cell.value = header
+                cell.fill = header_fill
+                cell.font = header_font
+            self.records.refresh(self.conn)
+            for row_idx, row in enumerate(self.reliability_rows(), 2):
+                for col_idx, value in enumerate(row, 1):
+                    ws_reliability.cell(row=row_idx, column=col_idx).value = value
+            ws_reliability.column_dimensions['A'].width = 30
+
+            ws_faults = wb.create_sheet("Guasti Ricorrenti")
+            for col, header in enumerate(['Cluster', 'Guasto', 'Macchina', 'Mese', 'Interventi'], 1):
+                cell = ws_faults.cell(row=1, column=col)
+                cell.value = header
+                cell.fill = header_fill
+                cell.font = header_font
+            for row_idx, row in enumerate(self.recurring_fault_rows(), 2):
+                for col_idx, value in enumerate(row, 1):
+                    ws_faults.cell(row=row_idx, column=col_idx).value = value
+            ws_faults.column_dimensions['B'].width = 45
+            ws_faults.column_dimensions['C'].width = 25
             
             wb.save(file_path)
             messagebox.showinfo("Successo", f"Dati esportati con successo!\n\n{len(records)} interventi salvati in:\n{file_path}")
@@ -1048,8 +4324,285 @@ SOLUZIONE:
         except Exception as e:
             messagebox.showerror("Errore Export", f"Errore durante l'export: {e}")
     
+    def export_sync_bundle(self):
+        peers = self.conn.execute('SELECT istanza, nome FROM sync_peer ORDER BY nome').fetchall()
+        full_export = "(nuova sede - esportazione completa)"
+        choices = [f"{nome} ({istanza[:8]})" for istanza, nome in peers] + [full_export]
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Esporta Modifiche")
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+        frame = ttk.Frame(dialog, padding="15")
+        frame.pack(fill='both', expand=True)
+
+        ttk.Label(frame, text=f"Questa sede: {self.get_setting('nome_sede')} ({self.get_setting('istanza_id')[:8]})").pack(anchor=tk.W)
+        ttk.Label(frame, text="Sede destinazione:").pack(anchor=tk.W, pady=(10, 5))
+        peer_combo = ttk.Combobox(frame, values=choices, state="readonly", width=45)
+        peer_combo.current(0)
+        peer_combo.pack(fill='x')
+
+        def confirm():
+            index = peer_combo.current()
+            dialog.destroy()
+            self.write_sync_bundle(peers[index][0] if index < len(peers) else None)
+
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(pady=(15, 0))
+        ttk.Button(btn_frame, text="📦 Esporta", command=confirm).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Annulla", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+
+    def write_sync_bundle(self, peer):
+        if getattr(self, 'sync_export_running', False):
+            messagebox.showinfo("Esportazione", "Esportazione già in corso.")
+            return
+        file_path = filedialog.asksaveasfilename(
+            title="Salva Pacchetto Modifiche",
+            defaultextension=".mtsync",
+            filetypes=[("Pacchetto modifiche", "*.mtsync"), ("Tutti i file", "*.*")],
+            initialfile=f"modifiche_{self.get_setting('nome_sede')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mtsync"
+        )
+        if not file_path:
+            return
+
+        self.sync_export_running = True
+        self.conn.commit()
+        self.root.config(cursor='watch')
+
+        def on_done(stats):
+            self.sync_export_running = False
+            self.root.config(cursor='')
+            messagebox.showinfo("Esportazione", f"Pacchetto creato!\n\n"
+                                f"Modifiche: {stats['modifiche']}\nAllegati inclusi: {stats['allegati']}\n\n{file_path}")
+
+        def on_error(error):
+            self.sync_export_running = False
+            self.root.config(cursor='')
+            messagebox.showerror("Errore Esportazione", f"Errore durante l'esportazione: {error}")
+
+        self.run_in_background(write_sync_bundle_job, self.db_path, file_path, peer, on_done=on_done, on_error=on_error)
+
+    def import_sync_bundle(self):
+        file_path = filedialog.askopenfilename(
+            title="Seleziona Pacchetto Modifiche",
+            filetypes=[("Pacchetto modifiche", "*.mtsync"), ("Tutti i file", "*.*")]
+        )
+        if not file_path:
+            return
+
+        try:
+            with zipfile.ZipFile(file_path) as bundle:
+                manifest = json.loads(bundle.read('manifest.json'))
+                if manifest.get('formato') != SYNC_BUNDLE_VERSION:
+                    raise ValueError("Formato del pacchetto non supportato")
+
+                origin = manifest['origine']
+                if origin == self.get_setting('istanza_id'):
+                    raise ValueError("Il pacchetto è stato creato da questa sede")
+
+                peer = self.conn.execute('SELECT ultimo_seq_ricevuto FROM sync_peer WHERE istanza = ?', (origin,)).fetchone()
+                if peer and manifest['da_seq'] is not None and manifest['a_seq'] <= peer[0]:
+                    # Le conferme di ricezione contenute restano comunque valide
+                    self._record_sync_ack(origin, manifest)
+                    self.conn.commit()
+                    messagebox.showinfo("Importazione", "Pacchetto già importato, nessuna modifica da applicare.")
+                    return
+
+                stats = self.apply_sync_bundle(bundle, manifest)
+        except (sqlite3.Error, OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            messagebox.showerror("Errore Importazione", f"Errore durante l'importazione: {e}")
+            return
+
+        self.notify_records_changed(**stats['interventi'])
+        # Le immagini degli interventi nuovi sono gia' state indicizzate da notify_records_changed
+        new_records = set(stats['interventi']['inserted'])
+        self.update_image_index(images=[(allegato_id, phash) for allegato_id, intervento_id, phash in stats['immagini']
+                                        if intervento_id not in new_records])
+        self.load_all_records()
+        msg = (f"Importazione da '{manifest['nome_origine']}' completata!\n\n"
+               f"Nuovi: {stats['inserted']}\nAggiornati: {stats['updated']}\nEliminati: {stats['deleted']}")
+        if stats['missing']:
+            msg += f"\n\n⚠️ {stats['missing']} allegati senza contenuto disponibile (richiedi un'esportazione completa)"
+        messagebox.showinfo("Importazione", msg)
+
+    def apply_sync_bundle(self, bundle, manifest):
+        """Applica le modifiche in un'unica transazione; riapplicare lo stesso pacchetto non cambia nulla"""
+        origin = manifest['origine']
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'missing': 0, 'immagini': [], 'allegati_interventi': set(),
+                 'interventi': {'inserted': [], 'updated': [], 'deleted': []}}
+        known_hashes = set()
+
+        try:
+            self.conn.execute("INSERT OR REPLACE INTO impostazioni (chiave, valore) VALUES ('sync_origine', ?)", (origin,))
+
+            with bundle.open('modifiche.jsonl') as changes:
+                for line in io.TextIOWrapper(changes, encoding='utf-8'):
+                    change = json.loads(line)
+                    if change['tabella'] == 'interventi':
+                        self._apply_intervento_change(change, stats)
+                    else:
+                        self._apply_allegato_change(change, bundle, stats)
+                        if change['op'] == 'U':
+                            known_hashes.add(change['dati']['hash_contenuto'])
+
+            self.conn.execute("DELETE FROM impostazioni WHERE chiave = 'sync_origine'")
+            self.conn.execute('''
+                INSERT INTO sync_peer (istanza, nome, ultimo_seq_ricevuto) VALUES (?, ?, ?)
+                ON CONFLICT(istanza) DO UPDATE SET nome = excluded.nome,
+                    ultimo_seq_ricevuto = MAX(ultimo_seq_ricevuto, excluded.ultimo_seq_ricevuto)
+            ''', (origin, manifest['nome_origine'], manifest['a_seq']))
+            self._record_sync_ack(origin, manifest)
+            self.conn.executemany('INSERT OR IGNORE INTO sync_hash_peer (istanza, hash) VALUES (?, ?)',
+                                  [(origin, content_hash) for content_hash in known_hashes])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        # Allegati aggiunti o tolti a interventi gia' in cache: conteggi e filtro allegati da rileggere;
+        # gli interventi nuovi, eliminati o modificati li aggiorna notify_records_changed
+        interventi = stats['interventi']
+        touched = stats['allegati_interventi'] - set(interventi['inserted']) - set(interventi['deleted']) - set(interventi['updated'])
+        self.records.reload_rows(self.conn, touched)
+        return stats
+
+    def _record_sync_ack(self, origin, manifest):
+        """Registra fin dove la sede ha ricevuto i nostri pacchetti: le esportazioni successive partono da li'"""
+        ack = (manifest.get('conferme') or {}).get(self.get_setting('istanza_id'))
+        row = self.conn.execute('SELECT ultimo_seq_inviato FROM sync_peer WHERE istanza = ?', (origin,)).fetchone()
+        if ack is None or row is None or ack <= row[0]:
+            return
+        # Contenuti ormai presenti presso la sede: allegati la cui ultima modifica rientra nella conferma
+        self.conn.execute('''
+            INSERT OR IGNORE INTO sync_hash_peer (istanza, hash)
+            SELECT ?, a.hash_contenuto FROM allegati a
+            JOIN (SELECT uuid, MAX(seq) AS ultimo FROM registro_modifiche
+                  WHERE tabella = 'allegati' AND seq > ? GROUP BY uuid) r ON r.uuid = a.uuid
+            WHERE r.ultimo <= ?
+        ''', (origin, row[0], ack))
+        self.conn.execute('UPDATE sync_peer SET ultimo_seq_inviato = ? WHERE istanza = ?', (ack, origin))
+
+    def _apply_intervento_change(self, change, stats):
+        row = self.conn.execute(f'''
+            SELECT id, {', '.join(SYNC_INTERVENTO_FIELDS)} FROM interventi WHERE uuid = ?
+        ''', (change['uuid'],)).fetchone()
+
+        if change['op'] == 'D':
+            if row:
+                self.conn.execute('DELETE FROM allegati WHERE intervento_id = ?', (row[0],))
+                self.conn.execute('DELETE FROM interventi WHERE id = ?', (row[0],))
+                stats['deleted'] += 1
+                stats['interventi']['deleted'].append(row[0])
+            return
+
+        values = tuple(change['dati'][field] for field in SYNC_INTERVENTO_FIELDS)
+        if row is None:
+            self.conn.execute(f'''
+                INSERT INTO interventi (uuid, {', '.join(SYNC_INTERVENTO_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (change['uuid'],) + values)
+            stats['inserted'] += 1
+            stats['interventi']['inserted'].append(self.conn.execute('SELECT last_insert_rowid()').fetchone()[0])
+        elif tuple(row[1:]) != values:
+            self.conn.execute(f'''
+                UPDATE interventi SET {', '.join(f'{field} = ?' for field in SYNC_INTERVENTO_FIELDS)} WHERE id = ?
+            ''', values + (row[0],))
+            stats['updated'] += 1
+            stats['interventi']['updated'].append(row[0])
+
+    def _apply_allegato_change(self, change, bundle, stats):
+        row = self.conn.execute('''
+            SELECT id, intervento_id, nome_file, tipo_file, hash_contenuto FROM allegati WHERE uuid = ?
+        ''', (change['uuid'],)).fetchone()
+
+        if change['op'] == 'D':
+            if row:
+                self.conn.execute('DELETE FROM allegati WHERE id = ?', (row[0],))
+                stats['deleted'] += 1
+                stats['allegati_interventi'].add(row[1])
+            return
+
+        data = change['dati']
+        parent = self.conn.execute('SELECT id FROM interventi WHERE uuid = ?', (data['intervento_uuid'],)).fetchone()
+        if parent is None:
+            return
+
+        metadata = (parent[0], data['nome_file'], data['tipo_file'])
+        if row is not None and row[4] == data['hash_contenuto']:
+            if tuple(row[1:4]) != metadata:
+                self.conn.execute('UPDATE allegati SET intervento_id = ?, nome_file = ?, tipo_file = ? WHERE id = ?',
+                                  metadata + (row[0],))
+                stats['updated'] += 1
+                stats['allegati_interventi'].update((row[1], parent[0]))
+            return
+
+        content = self._sync_content(data['hash_contenuto'], bundle)
+        if content is None:
+            stats['missing'] += 1
+            return
+
+        contenuto, codec = content
+        hashes = self._sync_image_hashes(data, contenuto, codec)
+        if row is None:
+            self.conn.execute('''
+                INSERT INTO allegati (uuid, intervento_id, nome_file, tipo_file, contenuto, codec, hash_contenuto, dhash, phash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (change['uuid'],) + metadata + (contenuto, codec, data['hash_contenuto']) + hashes)
+            allegato_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            stats['inserted'] += 1
+        else:
+            self.conn.execute('''
+                UPDATE allegati SET intervento_id = ?, nome_file = ?, tipo_file = ?, contenuto = ?, codec = ?, hash_contenuto = ?,
+                    dhash = ?, phash = ?
+                WHERE id = ?
+            ''', metadata + (contenuto, codec, data['hash_contenuto']) + hashes + (row[0],))
+            allegato_id = row[0]
+            stats['updated'] += 1
+            stats['allegati_interventi'].add(row[1])
+        stats['allegati_interventi'].add(parent[0])
+        if hashes[1] is not None:
+            stats['immagini'].append((allegato_id, parent[0], hashes[1]))
+
+    def _sync_image_hashes(self, data, contenuto, codec):
+        """dHash/pHash di un'immagine ricevuta: dal pacchetto, da una copia locale o ricalcolati"""
+        if data['tipo_file'] != 'image':
+            return None, None
+        if data.get('phash') is not None:
+            return data['dhash'], data['phash']
+        local = self.conn.execute('''
+            SELECT dhash, phash FROM allegati WHERE hash_contenuto = ? AND phash IS NOT NULL LIMIT 1
+        ''', (data['hash_contenuto'],)).fetchone()
+        if local:
+            return local
+        try:
+            return perceptual_hashes(b''.join(iter_decompressed(codec, [contenuto])))
+        except Exception:
+            return None, None
+
+    def _sync_content(self, content_hash, bundle):
+        """Contenuto per un hash: prima dagli allegati locali, poi dal pacchetto"""
+        local = self.conn.execute('SELECT contenuto, codec FROM allegati WHERE hash_contenuto = ? LIMIT 1',
+                                  (content_hash,)).fetchone()
+        if local:
+            return local
+
+        try:
+            data = bundle.read(f'blob/{content_hash}')
+        except KeyError:
+            return None
+        if hashlib.sha256(data).hexdigest() != content_hash:
+            raise ValueError(f"Allegato corrotto nel pacchetto: {content_hash}")
+
+        codec, contenuto = compress_payload(data)
+        return contenuto, codec
+
     def __del__(self):
         """Chiude connessione database"""
+        if getattr(self, 'lag_watchdog', None):
+            self.lag_watchdog.stop()
+        if hasattr(self, 'archive_cancel'):
+            self.archive_cancel.set()
+        if hasattr(self, 'executor'):
+            self.executor.shutdown(wait=False, cancel_futures=True)
         if hasattr(self, 'conn'):
             self.conn.close()
 